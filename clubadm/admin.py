@@ -1,4 +1,4 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.http import Http404, HttpResponseRedirect, JsonResponse
@@ -6,14 +6,17 @@ from django.utils.html import format_html
 from django.utils.http import urlencode
 from django.views.decorators.cache import never_cache
 
+from clubadm import caching
 from clubadm.forms import SeasonForm
 from clubadm.models import Member, Season, User
 from clubadm.signals import user_banned, user_unbanned
-from clubadm.tasks import match_members
+from clubadm.tasks import (
+    get_simulation_cache_key, match_members, run_matching_simulation)
 
 
 class SeasonAdmin(admin.ModelAdmin):
-    actions = ("match_members", "give_badges", "block_members", "clear_cache")
+    actions = ("match_members", "simulate_matching", "give_badges",
+               "block_members", "clear_cache")
     fieldsets = (
         (None, {
             "fields": ("year",)
@@ -27,7 +30,7 @@ class SeasonAdmin(admin.ModelAdmin):
     )
     form = SeasonForm
     list_display = ("year", "signups_start", "signups_end", "ship_by",
-                    "is_closed", "is_participatable")
+                    "is_closed", "is_participatable", "matching", "simulation")
     ordering = ("year",)
 
     def get_readonly_fields(self, request, obj=None):
@@ -50,10 +53,29 @@ class SeasonAdmin(admin.ModelAdmin):
 
     def match_members(self, request, queryset):
         for obj in queryset:
-            match_members.delay(obj.year)
-        self.message_user(request, "Процесс сортировки был запущен")
+            if obj.matching == Season.MATCHING_PENDING:
+                match_members.delay(obj.year)
+                self.message_user(request, "%s: процесс сортировки был "
+                                  "запущен" % obj)
+            else:
+                self.message_user(request, "%s: жеребьевка уже %s" % (
+                    obj, obj.get_matching_display()), level=messages.WARNING)
     match_members.short_description = "Провести жеребьевку"
 
+    def simulate_matching(self, request, queryset):
+        # Жеребьевка на десятках тысяч участников занимает время, так что
+        # проводим ее в воркере, а отчет потом появится в списке сезонов.
+        for obj in queryset:
+            cache.delete(get_simulation_cache_key(obj.year))
+            run_matching_simulation.delay(obj.year)
+        self.message_user(request, "Пробная жеребьевка запущена, отчет "
+                          "появится в списке сезонов")
+    simulate_matching.short_description = "Пробная жеребьевка (без записи)"
+
+    def simulation(self, obj):
+        return cache.get(get_simulation_cache_key(obj.year), "")
+    simulation.short_description = "пробная жеребьевка"
+
     def give_badges(self, request, queryset):
         array = []
         for obj in queryset:
@@ -74,8 +96,8 @@ class SeasonAdmin(admin.ModelAdmin):
 
     def clear_cache(self, request, queryset):
         for obj in queryset:
-            cache.delete(obj.cache_key)
-        cache.delete("season:latest")
+            caching.purge(obj.cache_key)
+        caching.purge(Season.LATEST_CACHE_KEY)
         self.message_user(request, "Кеш успешно очищен")
     clear_cache.short_description = "Очистить кеш"
 
@@ -169,7 +191,9 @@ class UserAdmin(admin.ModelAdmin):
         return "https://habrahabr.ru/users/%s/" % obj.username
 
     def ban(self, request, queryset):
+        user_ids = list(queryset.values_list("pk", flat=True))
         queryset.update(is_banned=True)
+        User.objects.invalidate(user_ids)
     ban.short_description = "Забанить выбранных пользователей"
 
     def get_karma(self, obj):
@@ -201,6 +225,7 @@ class UserAdmin(admin.ModelAdmin):
 
 
 class MemberAdmin(admin.ModelAdmin):
+    actions = ("unmatch",)
     fieldsets = (
         (None, {
             "fields": ("user", "season", "giftee_link", "santa_link")
@@ -225,6 +250,24 @@ class MemberAdmin(admin.ModelAdmin):
     def has_delete_permission(self, request, obj=None):
         return obj is not None and obj.giftee is None
 
+    def save_model(self, request, obj, form, change):
+        super(MemberAdmin, self).save_model(request, obj, form, change)
+        # Даты подарков видны еще и Деду Морозу и получателю участника.
+        Member.objects.invalidate_season(obj.season_id)
+
+    def unmatch(self, request, queryset):
+        unmatched = 0
+        for obj in queryset:
+            try:
+                if obj.unmatch():
+                    unmatched += 1
+            except ValueError as e:
+                self.message_user(request, str(e), level=messages.WARNING)
+        if unmatched:
+            self.message_user(request, "Исключено из жеребьевки участников: "
+                              "%d" % unmatched)
+    unmatch.short_description = "Исключить из жеребьевки"
+
     def is_gift_sent(self, obj):
         return obj.is_gift_sent
     is_gift_sent.boolean = True
@@ -1,11 +1,13 @@
-import requests
 import secrets
+import time
 
 from django.conf import settings
 from django.contrib.auth.backends import ModelBackend
 from django.core.cache import cache
 
+from clubadm import http
 from clubadm.models import User
+from clubadm.tasks import refresh_remote_user
 
 
 class TechMediaBackend(ModelBackend):
@@ -33,21 +35,50 @@ class TechMediaBackend(ModelBackend):
         return user
 
     def get_remote_user(self, access_token):
+        return self.get_remote_profile(access_token)[0]
+
+    def get_remote_profile(self, access_token):
+        """
+        Возвращает профиль пользователя на Хабре и время, когда он был
+        получен. Профиль старше CLUBADM_REMOTE_SOFT_TTL отдается как есть,
+        но в фоне обновляется. Профиль старше CLUBADM_REMOTE_HARD_TTL
+        вытесняется из кеша, и запрос ждет ответа от Хабра.
+        """
         if not access_token:
-            return None
-        user_key = "token:%s" % access_token
-        user = cache.get(user_key)
-        if not user:
-            url = "%s/users/me" % settings.TMAUTH_ENDPOINT_URL
-            response = requests.get(url, headers={
-                "client": settings.TMAUTH_CLIENT,
-                "token": access_token
-            })
-            if response.status_code != 200:
-                return False
-            user = response.json().get("data")
-            cache.set(user_key, user)
-        return user
+            return None, None
+        profile = cache.get(self._get_cache_key(access_token))
+        if not profile:
+            return self.fetch_remote_profile(access_token)
+        user, fetched = profile
+        if time.time() - fetched > settings.CLUBADM_REMOTE_SOFT_TTL:
+            if cache.add(self._get_refresh_key(access_token), True,
+                         timeout=settings.CLUBADM_REMOTE_SOFT_TTL):
+                refresh_remote_user.delay(access_token)
+        return user, fetched
+
+    def fetch_remote_profile(self, access_token):
+        user_key = self._get_cache_key(access_token)
+        url = "%s/users/me" % settings.TMAUTH_ENDPOINT_URL
+        response = http.get("habr.users_me", url, headers={
+            "client": settings.TMAUTH_CLIENT,
+            "token": access_token
+        })
+        if response.status_code != 200:
+            # Токен, скорее всего, отозван. Пусть следующий запрос тоже
+            # сходит на Хабр, а не получит старый профиль.
+            cache.delete(user_key)
+            return False, None
+        user = response.json().get("data")
+        fetched = time.time()
+        cache.set(user_key, (user, fetched),
+                  timeout=settings.CLUBADM_REMOTE_HARD_TTL)
+        return user, fetched
+
+    def refresh_remote_profile(self, access_token):
+        try:
+            return self.fetch_remote_profile(access_token)
+        finally:
+            cache.delete(self._get_refresh_key(access_token))
 
     def get_user(self, user_id):
         try:
@@ -57,3 +88,9 @@ class TechMediaBackend(ModelBackend):
         if not user.remote:
             return None
         return user
+
+    def _get_cache_key(self, access_token):
+        return "token:%s" % access_token
+
+    def _get_refresh_key(self, access_token):
+        return "token:%s:refresh" % access_token
@@ -0,0 +1,247 @@
+import collections
+import copy
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+
+LOCK_TIMEOUT = 10
+
+WAIT_TIMEOUT = 2.0
+
+WAIT_INTERVAL = 0.05
+
+
+def get_stale_key(key):
+    return "%s:stale" % key
+
+
+def get_lock_key(key):
+    return "%s:lock" % key
+
+
+def get_version_key(key):
+    return "%s:version" % key
+
+
+def set_value(key, value, timeout=None):
+    # Рядом с основным значением храним его копию, которую никто не удаляет
+    # при инвалидации. Ее отдаем, пока кто-то другой пересчитывает основное.
+    cache.set_many({
+        key: value,
+        get_stale_key(key): value,
+    }, timeout=timeout)
+
+
+def delete_value(key):
+    cache.delete_many([key, get_stale_key(key)])
+
+
+def _get_current(key, version):
+    # Если задана версия, в кеше лежит пара (версия, значение), и значение
+    # под другой версией считается промахом.
+    value = cache.get(key)
+    if version is None or value is None:
+        return value
+    if value[0] != version:
+        return None
+    return value[1]
+
+
+def _get_stale(key, version):
+    value = cache.get(get_stale_key(key))
+    if version is None or value is None:
+        return value
+    return value[1]
+
+
+def _get_or_rebuild(key, rebuild, timeout=None, version=None):
+    # Возвращает значение и признак того, что оно свежее, а не устаревшая
+    # копия, которую отдали, пока кто-то другой его пересчитывает.
+    value = _get_current(key, version)
+    if value is not None:
+        return value, True
+    lock_key = get_lock_key(key)
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while True:
+        if cache.add(lock_key, True, timeout=LOCK_TIMEOUT):
+            try:
+                value = rebuild()
+                # Если значение успели инвалидировать, пока мы его считали,
+                # оно останется под старой версией и никто его не примет.
+                set_value(key, value if version is None else (version, value),
+                          timeout=timeout)
+            finally:
+                cache.delete(lock_key)
+            return value, True
+        value = _get_stale(key, version)
+        if value is not None:
+            return value, False
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(WAIT_INTERVAL)
+        value = _get_current(key, version)
+        if value is not None:
+            return value, True
+    # Тот, кто взял блокировку, слишком долго возится. Лучше сходить в базу
+    # самим, чем держать пользователя.
+    logger.warning("Не дождались пересчета %s", key)
+    return rebuild(), True
+
+
+def get_or_rebuild(key, rebuild, timeout=None):
+    """
+    Достает значение из кеша, а при промахе пересчитывает его, причем только
+    в одном процессе за раз. Остальные получают предыдущую версию значения,
+    а если ее нет, ждут не дольше WAIT_TIMEOUT секунд.
+    """
+    return _get_or_rebuild(key, rebuild, timeout=timeout)[0]
+
+
+def get_version(key):
+    version_key = get_version_key(key)
+    version = cache.get(version_key)
+    if version is None:
+        # Memcached мог вытеснить ключ с версией. Начинаем со случайного
+        # числа, чтобы не совпасть с версией, которая осталась у кого-то
+        # в локальном кеше.
+        cache.add(version_key, random.getrandbits(48), timeout=None)
+        version = cache.get(version_key)
+    return version
+
+
+def get_versions(keys):
+    """
+    Возвращает версии сразу для нескольких ключей за один запрос к кешу.
+    """
+    version_keys = [get_version_key(key) for key in keys]
+    cached = cache.get_many(version_keys)
+    versions = []
+    for key, version_key in zip(keys, version_keys):
+        version = cached.get(version_key)
+        if version is None:
+            version = get_version(key)
+        versions.append(version)
+    return versions
+
+
+def touch(key):
+    """
+    Сообщает всем процессам, что их копии значения устарели, и возвращает
+    новую версию.
+    """
+    version_key = get_version_key(key)
+    try:
+        return cache.incr(version_key)
+    except ValueError:
+        cache.add(version_key, random.getrandbits(48), timeout=None)
+        return cache.get(version_key)
+
+
+def invalidate(key):
+    cache.delete(key)
+    touch(key)
+
+
+def purge(key):
+    # В отличие от invalidate(), удаляет и устаревшую копию, так что ее уже
+    # никто не получит, даже пока значение пересчитывается.
+    delete_value(key)
+    touch(key)
+
+
+class LocalCache(object):
+    """
+    LRU-кеш в памяти процесса. Каждое значение хранится вместе с версией,
+    которую оно имело в общем кеше, и считается валидным, пока та не
+    изменилась.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            try:
+                cached_version, value = self._data[key]
+            except KeyError:
+                return None
+            if cached_version != version:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, version, value):
+        with self._lock:
+            self._data[key] = (version, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+local_cache = LocalCache(settings.CLUBADM_LOCAL_CACHE_SIZE)
+
+
+def get_versioned(key, rebuild, timeout=None, version=None):
+    """
+    То же, что и get_or_rebuild(), но сначала смотрит в локальный кеш.
+    На каждое обращение приходится один запрос к memcached за версией,
+    если только вызывающий не достал ее сам заодно с чем-то еще.
+    """
+    if version is None:
+        version = get_version(key)
+    value = local_cache.get(key, version)
+    if value is None:
+        value, fresh = _get_or_rebuild(key, rebuild, timeout=timeout,
+                                       version=version)
+        if not fresh:
+            return value
+        local_cache.set(key, version, value)
+    # Отдаем копию, чтобы изменения в одном запросе не попали в другие.
+    return copy.copy(value)
+
+
+def get_or_load(key, load, timeout=None):
+    """
+    Простой read-through кеш, но значение хранится вместе с версией, под
+    которой оно было прочитано из базы. Если кто-то успел изменить запись
+    и вызвать touch(), пока мы ее читали, то наша копия не будет принята
+    за свежую, и следующее обращение перечитает ее заново.
+    """
+    version_key = get_version_key(key)
+    cached = cache.get_many([key, version_key])
+    version = cached.get(version_key)
+    if version is None:
+        version = get_version(key)
+    entry = cached.get(key)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    value = load()
+    cache.set(key, (version, value), timeout=timeout)
+    return value
+
+
+def set_versioned(key, value, timeout=None):
+    """
+    Кладет новое значение для get_versioned() и сообщает всем процессам,
+    что их копии устарели.
+    """
+    set_value(key, (touch(key), value), timeout=timeout)
+
+
+def set_loaded(key, value, timeout=None):
+    cache.set(key, (touch(key), value), timeout=timeout)
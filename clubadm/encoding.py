@@ -0,0 +1,20 @@
+import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def dumps(data):
+    """
+    Компактный JSON для ответов. Если установлен ujson, кодируем им: он
+    в несколько раз быстрее стандартного модуля.
+    """
+    if ujson is not None:
+        return ujson.dumps(data, ensure_ascii=False,
+                           escape_forward_slashes=False)
+    return _encoder.encode(data)
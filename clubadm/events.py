@@ -0,0 +1,65 @@
+import logging
+
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+
+# Сколько живет одно событие. Клиент, который отстал сильнее, получит
+# вместо событий null и перечитает все через sync.
+EVENT_TIMEOUT = 10 * 60
+
+# Больше событий за раз не отдаем, проще перечитать все заново.
+MAX_EVENTS = 100
+
+
+def _get_last_id_key(member_id):
+    return "events:%d" % member_id
+
+
+def _get_event_key(member_id, event_id):
+    return "events:%d:%d" % (member_id, event_id)
+
+
+def get_last_id(member_id):
+    return cache.get(_get_last_id_key(member_id)) or 0
+
+
+def publish(member_id, event_type, data=None):
+    """
+    Кладет событие в канал участника. Каналом служит счетчик в кеше плюс
+    отдельный ключ на каждое событие, так что публикация стоит два запроса
+    к кешу и ни одного к базе.
+    """
+    last_id_key = _get_last_id_key(member_id)
+    try:
+        event_id = cache.incr(last_id_key)
+    except ValueError:
+        cache.add(last_id_key, 0, timeout=None)
+        event_id = cache.incr(last_id_key)
+    cache.set(_get_event_key(member_id, event_id), {
+        "type": event_type,
+        "data": data or {},
+    }, timeout=EVENT_TIMEOUT)
+    return event_id
+
+
+def poll(member_id, since_id):
+    """
+    Возвращает номер последнего события и список событий после since_id.
+    Вместо списка возвращает None, если часть событий уже потерялась,
+    например вытеснена из кеша: тогда клиенту нужно перечитать все заново.
+    """
+    last_id = get_last_id(member_id)
+    if last_id == since_id:
+        return last_id, []
+    if last_id < since_id or last_id - since_id > MAX_EVENTS:
+        # Счетчик вытеснили из кеша, и он начался заново, или клиент отстал.
+        return last_id, None
+    keys = [_get_event_key(member_id, event_id)
+            for event_id in range(since_id + 1, last_id + 1)]
+    events = cache.get_many(keys)
+    if len(events) != len(keys):
+        return last_id, None
+    return last_id, [events[key] for key in keys]
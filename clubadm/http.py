@@ -0,0 +1,133 @@
+import logging
+import os
+import threading
+import urllib.parse
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+
+# Все внешние вызовы, для которых мы считаем статистику.
+ENDPOINTS = (
+    "habr.token",
+    "habr.users_me",
+    "habr.tracker",
+    "mailer.email",
+    "mailer.unsubscribe",
+)
+
+_session = None
+
+_session_pid = None
+
+_session_lock = threading.Lock()
+
+
+def _count_hosts():
+    # Пул соединений urllib3 заводит на каждый хост, а не на вызов.
+    urls = (settings.TMAUTH_TOKEN_URL, settings.TMAUTH_ENDPOINT_URL,
+            settings.CLUBADM_MAILER_URL)
+    return len(set(urllib.parse.urlsplit(url)[:2] for url in urls))
+
+
+def _create_session():
+    # Соединение, которое не установилось, можно повторить для любого
+    # запроса, а вот повторно читать ответ можно только у тех методов,
+    # которые ничего не меняют. Трекер Хабра на каждый PUT создает новое
+    # уведомление, так что PUT сюда не входит.
+    retry = Retry(total=3, connect=2, read=2, status=2, backoff_factor=0.2,
+                  status_forcelist=(502, 503, 504), raise_on_status=False,
+                  method_whitelist=frozenset(["HEAD", "GET", "OPTIONS"]))
+    adapter = HTTPAdapter(pool_connections=_count_hosts(),
+                          pool_maxsize=settings.CLUBADM_HTTP_POOL_SIZE,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    # Gunicorn и Celery форкают процессы после импорта, а открытые сокеты
+    # нельзя делить между процессами, поэтому сессия своя у каждого PID.
+    # Потоки одного процесса делят ее вместе с пулом соединений.
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session_pid != pid:
+        with _session_lock:
+            if _session_pid != pid:
+                _session = _create_session()
+                _session_pid = pid
+    return _session
+
+
+def _incr(key, delta):
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        if not cache.add(key, delta, timeout=None):
+            cache.incr(key, delta)
+
+
+def _record(endpoint, started, failed):
+    elapsed = int((time.monotonic() - started) * 1000)
+    _incr("http:%s:count" % endpoint, 1)
+    _incr("http:%s:time" % endpoint, elapsed)
+    if failed:
+        _incr("http:%s:errors" % endpoint, 1)
+
+
+def get_stats():
+    """
+    Возвращает для каждого внешнего вызова число запросов, число ошибок
+    и среднее время ответа в миллисекундах. Статистика общая для всех
+    процессов, потому что хранится в кеше.
+    """
+    keys = []
+    for endpoint in ENDPOINTS:
+        keys.extend(["http:%s:count" % endpoint, "http:%s:time" % endpoint,
+                     "http:%s:errors" % endpoint])
+    values = cache.get_many(keys)
+    stats = dict()
+    for endpoint in ENDPOINTS:
+        count = values.get("http:%s:count" % endpoint, 0)
+        elapsed = values.get("http:%s:time" % endpoint, 0)
+        stats[endpoint] = {
+            "count": count,
+            "errors": values.get("http:%s:errors" % endpoint, 0),
+            "latency": elapsed / count if count else None,
+        }
+    return stats
+
+
+def request(endpoint, method, url, **kwargs):
+    kwargs.setdefault("timeout", settings.CLUBADM_HTTP_TIMEOUT)
+    started = time.monotonic()
+    try:
+        response = get_session().request(method, url, **kwargs)
+    except requests.RequestException as e:
+        _record(endpoint, started, True)
+        logger.warning("%s %s: %s", method, url, e)
+        raise
+    _record(endpoint, started, response.status_code >= 500)
+    return response
+
+
+def get(endpoint, url, **kwargs):
+    return request(endpoint, "GET", url, **kwargs)
+
+
+def post(endpoint, url, **kwargs):
+    return request(endpoint, "POST", url, **kwargs)
+
+
+def put(endpoint, url, **kwargs):
+    return request(endpoint, "PUT", url, **kwargs)
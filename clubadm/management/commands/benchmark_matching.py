@@ -0,0 +1,52 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from clubadm.matching import Matcher, Participant
+
+
+class Command(BaseCommand):
+    help = "Замеряет жеребьевку на синтетическом сезоне"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--members", type=int, default=100000)
+        parser.add_argument("--seasons", type=int, default=5,
+                            help="Сколько прошлых сезонов учитывать")
+        parser.add_argument("--regions", type=int, default=80)
+        parser.add_argument("--by-region", action="store_true")
+        parser.add_argument("--seed", type=int, default=2016)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        count = options["members"]
+        # Регионы неравномерные: в первых нескольких живет большинство.
+        regions = ["%03d" % i for i in range(options["regions"])]
+        weights = [1.0 / (i + 1) for i in range(len(regions))]
+        participants = [
+            Participant(i, i, region) for i, region in enumerate(
+                rng.choices(regions, weights, k=count))
+        ]
+        history = []
+        for season in range(options["seasons"]):
+            users = rng.sample(range(count), int(count * 0.8))
+            history.extend(zip(users, users[1:] + users[:1]))
+        self.stdout.write("Участников: %d, пар в истории: %d" % (
+            count, len(history)))
+
+        for label, forbidden in (("без истории", ()), ("с историей", history)):
+            started = time.perf_counter()
+            matcher = Matcher(participants, forbidden=forbidden,
+                              by_region=options["by_region"],
+                              rng=random.Random(options["seed"]))
+            matcher.match()
+            elapsed = time.perf_counter() - started
+            # Нарушения считаем по полной истории, даже если жеребьевка
+            # о ней не знала, чтобы было с чем сравнить.
+            matcher.forbidden = Matcher([], history).forbidden
+            violations = matcher.count_violations()
+            self.stdout.write(
+                "%s: %.2f с, повторов с прошлых лет: %d, "
+                "переездов между регионами: %d" % (
+                    label, elapsed, violations["history"],
+                    violations["regions"]))
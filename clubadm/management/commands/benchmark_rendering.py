@@ -0,0 +1,68 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.template import engines
+
+from clubadm import rendering
+from clubadm.models import Season, User
+
+
+# Так уведомление о новом сообщении рендерилось до перехода на Jinja2:
+# текст через шаблон Django, а письмо через str.format().
+LEGACY_TEMPLATE = (
+    "Дед Мороз написал вам в анонимном чатике, непрочитанных сообщений: "
+    "{{ count }}. Прочитать их можно в <a href=\"https://habra-adm.ru/"
+    "{{ season.year }}/profile/\">профиле</a>.")
+
+
+def render_legacy_email(context):
+    return (
+        "Здравствуйте, {}!\n\nВаш Дед Мороз написал вам что-то в анонимном "
+        "чатике, ".format(context["user"].username) +
+        "непрочитанных сообщений: {}. ".format(context["count"]) +
+        "Посмотреть их можно в профиле: https://habra-adm.ru/{}/profile/"
+        .format(context["season"].year))
+
+
+class Command(BaseCommand):
+    help = "Сравнивает рендеринг уведомлений через Django и Jinja2"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        season = Season(year=2016)
+        contexts = [{
+            "season": season,
+            "count": i % 10 + 1,
+            "user": User(pk=i, username="user%d" % i),
+        } for i in range(options["messages"])]
+        engine = engines["django"]
+
+        def django_parse_each_time():
+            # render_to_string() без кеширующего загрузчика, как при DEBUG.
+            for context in contexts:
+                engine.from_string(LEGACY_TEMPLATE).render(context)
+                render_legacy_email(context)
+
+        def django_compiled():
+            template = engine.from_string(LEGACY_TEMPLATE)
+            for context in contexts:
+                template.render(context)
+                render_legacy_email(context)
+
+        def jinja2_batch():
+            rendering.render_messages("santa_mail", contexts)
+
+        # Первый вызов компилирует шаблон, его в замер не включаем.
+        rendering.render_message("santa_mail", contexts[0])
+        for label, func in (("Django, разбор на каждый вызов",
+                             django_parse_each_time),
+                            ("Django, скомпилированный шаблон",
+                             django_compiled),
+                            ("Jinja2, пачкой", jinja2_batch)):
+            started = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - started
+            self.stdout.write("%s: %.3f с, %.1f мкс на сообщение" % (
+                label, elapsed, elapsed / len(contexts) * 1000000))
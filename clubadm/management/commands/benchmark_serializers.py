@@ -0,0 +1,46 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from clubadm.models import Mail, Season
+from clubadm.serializers import (
+    MailSerializer, SeasonSerializer, serialize_mails, serialize_season)
+
+
+class Command(BaseCommand):
+    help = "Сравнивает сериализацию через DRF и быстрый путь"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--mails", type=int, default=50,
+                            help="Сколько сообщений в переписке")
+        parser.add_argument("--repeat", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        today = timezone.now().date()
+        season = Season(year=2016, signups_start=today, signups_end=today,
+                        ship_by=today + datetime.timedelta(days=30),
+                        member_count=5000, shipped_count=3000,
+                        delivered_count=1000)
+        now = timezone.now()
+        mails = [Mail(id=i, body="Сообщение %d" % i, sender_id=i % 2 + 1,
+                      recipient_id=2 - i % 2, send_date=now,
+                      read_date=now if i % 3 else None)
+                 for i in range(options["mails"])]
+
+        def drf():
+            SeasonSerializer(season).data
+            MailSerializer(mails, context={"author_id": 1}, many=True).data
+
+        def fast():
+            serialize_season(season)
+            serialize_mails(mails, 1)
+
+        for label, func in (("DRF", drf), ("быстрый путь", fast)):
+            started = time.perf_counter()
+            for _ in range(options["repeat"]):
+                func()
+            elapsed = time.perf_counter() - started
+            self.stdout.write("%s: %.3f с, %.1f мкс на ответ" % (
+                label, elapsed, elapsed / options["repeat"] * 1000000))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from clubadm import http
+
+
+class Command(BaseCommand):
+    help = "Показывает статистику запросов к Хабру и почтовому сервису"
+
+    def handle(self, *args, **options):
+        for endpoint, stats in sorted(http.get_stats().items()):
+            latency = stats["latency"]
+            self.stdout.write("%s: запросов %d, ошибок %d, в среднем %s мс" % (
+                endpoint, stats["count"], stats["errors"],
+                "-" if latency is None else "%.0f" % latency))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from clubadm.models import Season
+from clubadm.tasks import format_matching_report, match_members, simulate_matching
+
+
+class Command(BaseCommand):
+    help = "Проводит жеребьевку сезона или, с --dry-run, только примеряет ее"
+
+    def add_arguments(self, parser):
+        parser.add_argument("year", type=int)
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Ничего не записывать в базу, только отчет")
+        parser.add_argument("--force", action="store_true",
+                            help="Провести жеребьевку заново, даже если она "
+                                 "уже была")
+
+    def handle(self, *args, **options):
+        year = options["year"]
+        if not Season.objects.filter(pk=year).exists():
+            raise CommandError("Сезон %d не существует" % year)
+        if not options["dry_run"]:
+            match_members(year, force=options["force"])
+            return
+        try:
+            report = simulate_matching(year)
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(format_matching_report(year, report))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from clubadm.models import Season
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает счетчики участников и подарков для всех сезонов"
+
+    def handle(self, *args, **options):
+        for season in Season.objects.recount():
+            self.stdout.write("%s: участников %d, отправили %d, получили %d" % (
+                season, season.member_count, season.shipped_count,
+                season.delivered_count))
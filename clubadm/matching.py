@@ -0,0 +1,158 @@
+import collections
+import random
+import re
+
+
+# Сколько раз пытаемся найти подходящую замену для участника, прежде чем
+# сдаться и оставить нарушение как есть.
+MAX_SWAP_ATTEMPTS = 20
+
+MAX_PASSES = 5
+
+
+Participant = collections.namedtuple("Participant", "member_id user_id region")
+
+
+def get_region(postcode, digits=3):
+    """
+    Регион по почтовому индексу. В России первые три цифры индекса задают
+    город или область, для зарубежных индексов это просто их начало.
+    """
+    return re.sub(r"[^0-9A-Z]", "", postcode.upper())[:digits]
+
+
+def count_cycles(pairs):
+    """
+    Возвращает длины всех циклов, на которые распадаются пары. У правильной
+    жеребьевки цикл ровно один.
+    """
+    giftees = dict(pairs)
+    seen = set()
+    cycles = []
+    for start in giftees:
+        if start in seen:
+            continue
+        length = 0
+        member_id = start
+        while member_id not in seen:
+            seen.add(member_id)
+            member_id = giftees[member_id]
+            length += 1
+        cycles.append(length)
+    return cycles
+
+
+class Matcher(object):
+    """
+    Строит один цикл «Дед Мороз -> получатель» по всем участникам сезона.
+
+    Пары из forbidden (user_id, user_id) уже встречались в прошлых сезонах,
+    их мы по возможности избегаем в обе стороны. Если by_region включен,
+    участники одного региона идут в цикле подряд, так что подарки уезжают
+    в другой регион только на стыках.
+
+    Все работает за O(n log n): сортировка по регионам плюс локальные
+    перестановки, каждая из которых проверяется за O(1).
+    """
+
+    def __init__(self, participants, forbidden=(), by_region=False, rng=None):
+        self.participants = list(participants)
+        self.forbidden = set()
+        for santa_id, giftee_id in forbidden:
+            self.forbidden.add((santa_id, giftee_id))
+            self.forbidden.add((giftee_id, santa_id))
+        self.by_region = by_region
+        self.rng = rng or random.SystemRandom()
+
+    def match(self):
+        """
+        Возвращает список пар (member_id, giftee_member_id).
+        """
+        if len(self.participants) < 2:
+            raise ValueError("Для жеребьевки нужно хотя бы два участника")
+        self.order = list(self.participants)
+        self.rng.shuffle(self.order)
+        if self.by_region:
+            regions = list(set(p.region for p in self.order))
+            self.rng.shuffle(regions)
+            rank = dict((region, i) for i, region in enumerate(regions))
+            # Сортировка устойчива, так что внутри региона порядок остается
+            # случайным.
+            self.order.sort(key=lambda p: rank[p.region])
+        self._repair()
+        return self.get_pairs()
+
+    def get_pairs(self):
+        n = len(self.order)
+        return [(self.order[i].member_id, self.order[(i + 1) % n].member_id)
+                for i in range(n)]
+
+    def count_violations(self):
+        n = len(self.order)
+        history = regions = 0
+        for i in range(n):
+            if self._is_forbidden(i):
+                history += 1
+            if self.order[i].region != self.order[(i + 1) % n].region:
+                regions += 1
+        return {
+            "history": history,
+            "regions": regions,
+        }
+
+    def _is_forbidden(self, i):
+        n = len(self.order)
+        santa = self.order[i % n]
+        giftee = self.order[(i + 1) % n]
+        return (santa.user_id, giftee.user_id) in self.forbidden
+
+    def _count_forbidden(self, positions):
+        return sum(1 for i in positions if self._is_forbidden(i))
+
+    def _get_group_bounds(self):
+        n = len(self.order)
+        bounds = [None] * n
+        start = 0
+        for i in range(1, n + 1):
+            if i == n or self.order[i].region != self.order[start].region:
+                for j in range(start, i):
+                    bounds[j] = (start, i)
+                start = i
+        return bounds
+
+    def _try_swap(self, i, j):
+        # Меняем местами i-го и j-го участника, если это уменьшает число
+        # запрещенных пар среди четырех затронутых ребер.
+        n = len(self.order)
+        if i == j:
+            return False
+        edges = set([(i - 1) % n, i, (j - 1) % n, j])
+        before = self._count_forbidden(edges)
+        self.order[i], self.order[j] = self.order[j], self.order[i]
+        if self._count_forbidden(edges) < before:
+            return True
+        self.order[i], self.order[j] = self.order[j], self.order[i]
+        return False
+
+    def _repair(self):
+        if not self.forbidden:
+            return
+        n = len(self.order)
+        bounds = self._get_group_bounds() if self.by_region else None
+        for _ in range(MAX_PASSES):
+            improved = False
+            for i in range(n):
+                if not self._is_forbidden(i):
+                    continue
+                giftee = (i + 1) % n
+                start, end = bounds[giftee] if bounds else (0, n)
+                for attempt in range(MAX_SWAP_ATTEMPTS):
+                    # Сначала ищем замену в том же регионе, и только если
+                    # там никого не нашлось, по всему циклу.
+                    if attempt == MAX_SWAP_ATTEMPTS // 2:
+                        start, end = 0, n
+                    if self._try_swap(giftee, self.rng.randrange(start, end)):
+                        improved = True
+                        break
+            if not improved:
+                break
@@ -1,5 +1,6 @@
 from django.http import Http404
 from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
 
 from clubadm.models import Member, Season
 
@@ -18,11 +19,11 @@ class MemberMiddleware(object):
     def process_view(self, request, view_func, view_args, view_kwargs):
         if "year" in view_kwargs and request.user.is_authenticated:
             year = int(view_kwargs["year"])
-            try:
-                request.member = Member.objects.get_by_user_and_year(
-                    request.user, year)
-            except Member.DoesNotExist:
-                request.member = None
+            user_id = request.user.pk
+            # Многим страницам, например welcome, участник не нужен вовсе,
+            # так что достаем его только при первом обращении.
+            request.member = SimpleLazyObject(
+                lambda: Member.objects.get_cached(user_id, year))
 
 
 class XUserMiddleware(object):
@@ -33,4 +34,8 @@ class XUserMiddleware(object):
             return response
         # Чтобы Nginx мог писать имя пользователя в логи
         response["X-User"] = request.user.username
+        # И заодно то, насколько устарел его профиль с Хабра
+        remote_age = request.user.remote_age
+        if remote_age is not None:
+            response["X-Remote-Age"] = "%d" % remote_age
         return response
@@ -0,0 +1,47 @@
+from django.db import migrations, models
+
+
+def recount(apps, schema_editor):
+    Season = apps.get_model("clubadm", "Season")
+    Member = apps.get_model("clubadm", "Member")
+    for season in Season.objects.all():
+        members = Member.objects.filter(season=season)
+        season.member_count = members.count()
+        season.shipped_count = members.filter(gift_sent__isnull=False).count()
+        season.delivered_count = members.filter(
+            gift_received__isnull=False).count()
+        season.save()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("clubadm", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="season",
+            name="member_count",
+            field=models.IntegerField(
+                default=0, verbose_name="кол-во участников"),
+        ),
+        migrations.AddField(
+            model_name="season",
+            name="shipped_count",
+            field=models.IntegerField(
+                default=0, verbose_name="сколько отправили"),
+        ),
+        migrations.AddField(
+            model_name="season",
+            name="delivered_count",
+            field=models.IntegerField(
+                default=0, verbose_name="сколько получили"),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="email_token",
+            field=models.CharField(
+                blank=True, max_length=32, verbose_name="токен для отписки"),
+        ),
+        migrations.RunPython(recount, migrations.RunPython.noop),
+    ]
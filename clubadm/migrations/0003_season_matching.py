@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+def mark_matched(apps, schema_editor):
+    Season = apps.get_model("clubadm", "Season")
+    Season.objects.filter(member__giftee__isnull=False).update(matching=2)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("clubadm", "0002_season_counters"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="season",
+            name="matching",
+            field=models.IntegerField(
+                choices=[(0, "не проводилась"), (1, "идет"),
+                         (2, "проведена")],
+                default=0, verbose_name="жеребьевка"),
+        ),
+        migrations.RunPython(mark_matched, migrations.RunPython.noop),
+    ]
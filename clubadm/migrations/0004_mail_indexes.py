@@ -0,0 +1,35 @@
+from django.db import migrations, models
+from django.db.models import deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("clubadm", "0003_season_matching"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="mail",
+            index=models.Index(fields=["sender", "recipient", "send_date"],
+                               name="clubadm_mail_conversation"),
+        ),
+        # Составной индекс начинается с sender, так что отдельный индекс
+        # внешнего ключа больше не нужен.
+        migrations.AlterField(
+            model_name="mail",
+            name="sender",
+            field=models.ForeignKey(
+                db_index=False, on_delete=deletion.CASCADE, related_name="+",
+                to="clubadm.Member"),
+        ),
+        # Непрочитанные сообщения ищут read_mails() и рассылка дайджестов.
+        # Их всегда немного, так что частичный индекс почти ничего не весит.
+        # Django 1.11 не умеет описывать такие индексы в модели, но этот
+        # синтаксис понимают и PostgreSQL, и SQLite.
+        migrations.RunSQL(
+            "CREATE INDEX clubadm_mail_unread "
+            "ON clubadm_mail (recipient_id, sender_id, send_date) "
+            "WHERE read_date IS NULL",
+            "DROP INDEX clubadm_mail_unread",
+        ),
+    ]
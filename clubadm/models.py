@@ -1,42 +1,182 @@
 import datetime
 import logging
+import time
 
 from django.conf import settings
 from django.contrib import auth
 from django.core.cache import cache
-from django.db import models, connection
+from django.db import models, connection, transaction
 from django.http import Http404
-from django.template.loader import render_to_string
 from django.utils import timezone
 from django.utils.functional import cached_property
 
-from clubadm.tasks import send_notification
+from clubadm import caching, rendering
+from clubadm.tasks import (
+    get_digest_cache_key, send_email, send_mail_digest, send_notification)
 
 
 logger = logging.getLogger(__name__)
 
 
+# Более ранние сообщения не считаются непрочитанными и не отмечаются
+# прочитанными.
+MAIL_UNREAD_SINCE = timezone.make_aware(datetime.datetime(2016, 12, 20))
+
+
 def _get_mails_cache_key(member1, member2):
     # Чтобы один участник мог использовать кэш другого, сортируем параметры
     # ключа в порядке возрастания ID, независимо от порядка аргументов.
     return "mails:%d:%d" % tuple(sorted([member1.id, member2.id]))
 
 
+# Перенос счетчиков в базу и их пересчет не должны идти одновременно, иначе
+# одна и та же прибавка попадет в базу дважды.
+COUNTERS_LOCK_KEY = "season:counters:lock"
+
+COUNTERS_LOCK_TIMEOUT = 60
+
+
 class SeasonManager(models.Manager):
-    def get_queryset(self):
-        return super(SeasonManager, self).get_queryset().annotate(
-            members=models.Count("member", distinct=True),
-            sent=models.Count("member__gift_sent", distinct=True),
-            received=models.Count("member__gift_received", distinct=True))
+    # Эти счетчики копятся в кеше и переносятся в базу задачей
+    # flush_season_counters, чтобы каждый подарок не ждал блокировки строки
+    # сезона.
+    PENDING_COUNTERS = ("shipped_count", "delivered_count")
 
     def get_by_year(self, year):
         season_key = "season:%d" % int(year)
-        season = cache.get(season_key)
-        if not season:
-            season = self.get(pk=year)
-            cache.set(season_key, season, timeout=None)
+        # Версию сезона и прибавки к счетчикам достаем одним запросом.
+        pending_keys = self._get_pending_keys([int(year)])
+        version_key = caching.get_version_key(season_key)
+        values = cache.get_many([version_key] + list(pending_keys))
+        season = caching.get_versioned(season_key, lambda: self.get(pk=year),
+                                       version=values.get(version_key))
+        # get_versioned() отдает копию, так что ее можно менять.
+        for key, (_, field) in pending_keys.items():
+            setattr(season, field, getattr(season, field) +
+                    (values.get(key) or 0))
         return season
 
+    def _get_pending_keys(self, years):
+        return dict((self._get_pending_key(year, field), (year, field))
+                    for year in years for field in self.PENDING_COUNTERS)
+
+    def _get_pending_key(self, year, field):
+        return "season:%d:pending:%s" % (year, field)
+
+    def get_pending(self, year):
+        """
+        Возвращает еще не записанные в базу прибавки к счетчикам сезона.
+        """
+        keys = self._get_pending_keys([year])
+        pending = cache.get_many(keys.keys())
+        return dict((field, pending.get(key) or 0)
+                    for key, (_, field) in keys.items())
+
+    def increment(self, year, field):
+        try:
+            cache.incr(self._get_pending_key(year, field))
+        except ValueError:
+            # Счетчик вытеснили из кеша, и до следующего пересчета его нет.
+            # Пишем прямо в базу, как раньше, чтобы ничего не потерять.
+            self.filter(pk=year).update(**{field: models.F(field) + 1})
+            caching.invalidate("season:%d" % year)
+
+    def _decr_pending(self, pending):
+        for key, delta in pending.items():
+            if not delta:
+                continue
+            try:
+                cache.decr(key, delta)
+            except ValueError:
+                # Ключ вытеснили, следующий перенос пересчитает счетчики.
+                pass
+
+    def flush(self):
+        """
+        Переносит накопленные в кеше прибавки в строки сезонов. Если хотя бы
+        одного счетчика в кеше нет, например после перезапуска memcached,
+        все счетчики пересчитываются по таблице участников.
+        """
+        if not cache.add(COUNTERS_LOCK_KEY, True,
+                         timeout=COUNTERS_LOCK_TIMEOUT):
+            logger.info("Счетчики сезонов уже переносятся")
+            return
+        try:
+            years = list(self.values_list("year", flat=True))
+            keys = self._get_pending_keys(years)
+            pending = cache.get_many(keys.keys())
+            if len(pending) != len(keys):
+                logger.warning("Счетчики сезонов пропали из кеша, "
+                               "пересчитываю")
+                self._recount()
+                return
+            for year in years:
+                deltas = dict((key, delta) for key, delta in pending.items()
+                              if delta and keys[key][0] == year)
+                if not deltas:
+                    continue
+                self.filter(pk=year).update(**dict(
+                    (keys[key][1], models.F(keys[key][1]) + delta)
+                    for key, delta in deltas.items()))
+                caching.invalidate("season:%d" % year)
+                # Вычитаем только после записи в базу. Все, что прибавят
+                # после get_many(), останется в кеше до следующего раза.
+                self._decr_pending(deltas)
+        finally:
+            cache.delete(COUNTERS_LOCK_KEY)
+
+    def get_latest(self):
+        return caching.get_versioned(Season.LATEST_CACHE_KEY, self.latest)
+
+    def recount(self):
+        # Счетчики обновляются во вьюхах и в flush(), но админка и ручные
+        # правки в базе их не трогают, поэтому иногда их нужно пересчитать.
+        # Дожидаемся, пока закончится перенос, он сам отпустит блокировку
+        # или она истечет.
+        while not cache.add(COUNTERS_LOCK_KEY, True,
+                            timeout=COUNTERS_LOCK_TIMEOUT):
+            time.sleep(0.1)
+        try:
+            return self._recount()
+        finally:
+            cache.delete(COUNTERS_LOCK_KEY)
+
+    def _recount(self):
+        # Сезоны блокируются до подсчета, чтобы не потерять инкременты от
+        # регистраций, которые придут в это время.
+        with transaction.atomic():
+            seasons = list(self.select_for_update())
+            # Прибавки, которые уже лежат в кеше, учтутся в подсчете ниже,
+            # поэтому потом ровно их и вычитаем, а не обнуляем счетчики:
+            # то, что прибавят после этой строчки, не потеряется. Дважды
+            # может посчитаться только подарок, который успел закоммититься,
+            # но еще не прибавился в кеше.
+            keys = self._get_pending_keys([season.year for season in seasons])
+            pending = cache.get_many(keys.keys())
+            # Без order_by() Django добавит в GROUP BY поля из сортировки
+            # Member и разобьет сезон на группы по fullname.
+            counts = Member.objects.order_by().values("season_id").annotate(
+                members=models.Count("id"),
+                sent=models.Count("gift_sent"),
+                received=models.Count("gift_received"))
+            counts = dict((row["season_id"], row) for row in counts)
+            for season in seasons:
+                row = counts.get(season.year, {})
+                season.member_count = row.get("members", 0)
+                season.shipped_count = row.get("sent", 0)
+                season.delivered_count = row.get("received", 0)
+                self.filter(pk=season.pk).update(
+                    member_count=season.member_count,
+                    shipped_count=season.shipped_count,
+                    delivered_count=season.delivered_count)
+        self._decr_pending(pending)
+        for key in keys:
+            if key not in pending:
+                cache.add(key, 0, timeout=None)
+        for season in seasons:
+            caching.invalidate(season.cache_key)
+        return seasons
+
 
 class Season(models.Model):
     year = models.IntegerField("год", primary_key=True)
@@ -46,9 +186,24 @@ class Season(models.Model):
     ship_by = models.DateField("последний срок отправки подарка", help_text=
                                "После этой даты сезон закрывается и уходит в"
                                "архив.")
-    member_count = models.IntegerField("кол-во участников")
-    shipped_count = models.IntegerField("сколько отправили")
-    delivered_count = models.IntegerField("сколько получили")
+    member_count = models.IntegerField("кол-во участников", default=0)
+    shipped_count = models.IntegerField("сколько отправили", default=0)
+    delivered_count = models.IntegerField("сколько получили", default=0)
+
+    MATCHING_PENDING = 0
+    MATCHING_RUNNING = 1
+    MATCHING_DONE = 2
+
+    MATCHING_CHOICES = (
+        (MATCHING_PENDING, "не проводилась"),
+        (MATCHING_RUNNING, "идет"),
+        (MATCHING_DONE, "проведена"),
+    )
+
+    matching = models.IntegerField("жеребьевка", choices=MATCHING_CHOICES,
+                                   default=MATCHING_PENDING)
+
+    LATEST_CACHE_KEY = "season:latest"
 
     objects = SeasonManager()
 
@@ -67,11 +222,15 @@ class Season(models.Model):
 
     def save(self, *args, **kwargs):
         super(Season, self).save(*args, **kwargs)
-        cache.set(self.cache_key, self, timeout=None)
+        caching.set_versioned(self.cache_key, self)
+        caching.invalidate(self.LATEST_CACHE_KEY)
 
     def delete(self, *args, **kwargs):
+        # После удаления Django обнуляет pk, так что ключ нужен заранее.
+        cache_key = self.cache_key
         super(Season, self).delete(*args, **kwargs)
-        cache.delete(self.cache_key)
+        caching.purge(cache_key)
+        caching.purge(self.LATEST_CACHE_KEY)
 
     def get_absolute_url(self):
         return '/%d/' % self.year
@@ -88,13 +247,13 @@ class Season(models.Model):
 
 class UserManager(models.Manager):
     def get_by_id(self, user_id):
-        #user_key = "user:%d" % int(user_id)
-        #user = cache.get(user_key)
-        #if not user:
-        #    user = self.get(pk=user_id)
-        #    cache.set(user_key, user, timeout=None)
-        #return user
-        return self.get(pk=user_id)
+        user_key = "user:%d" % int(user_id)
+        return caching.get_or_load(user_key, lambda: self.get(pk=user_id))
+
+    def invalidate(self, user_ids):
+        # Для случаев, когда записи меняются через update() в обход save().
+        for user_id in user_ids:
+            caching.invalidate("user:%d" % int(user_id))
 
 
 class User(models.Model):
@@ -116,6 +275,8 @@ class User(models.Model):
     is_anonymous = False
     is_authenticated = True
 
+    remote_fetched = None
+
     USERNAME_FIELD = "username"
     REQUIRED_FIELDS = []
 
@@ -137,21 +298,33 @@ class User(models.Model):
     def cache_key(self):
         return "user:%d" % self.id
 
+    def __reduce__(self):
+        # Профиль с Хабра кешируется отдельно и со своим сроком жизни, так
+        # что в кеш пользователей он попадать не должен.
+        model_unpickle, args, data = super(User, self).__reduce__()
+        data = data.copy()
+        data.pop("remote", None)
+        data.pop("remote_fetched", None)
+        return model_unpickle, args, data
+
     def save(self, *args, **kwargs):
         super(User, self).save(*args, **kwargs)
-        cache.set(self.cache_key, self, timeout=None)
-        if not self.was_banned and self.is_banned:
+        was_banned, self.was_banned = self.was_banned, self.is_banned
+        # Экземпляр попадет в кеш пользователей, и при следующем save()
+        # уведомление не должно уйти повторно, поэтому was_banned обновлен
+        # до того, как мы его туда положим.
+        caching.set_loaded(self.cache_key, self)
+        if not was_banned and self.is_banned:
             logger.debug("Пользователь %s забанен", self.username)
-            self.send_notification("Ваш аккаунт заблокирован",
-                                   "clubadm/notifications/banned.html")
-        elif self.was_banned and not self.is_banned:
+            self.send_message("banned")
+        elif was_banned and not self.is_banned:
             logger.debug("Пользователь %s разбанен", self.username)
-            self.send_notification("Ваш аккаунт разблокирован",
-                                   "clubadm/notifications/unbanned.html")
+            self.send_message("unbanned")
 
     def delete(self, *args, **kwargs):
+        cache_key = self.cache_key
         super(User, self).delete(*args, **kwargs)
-        cache.delete(self.cache_key)
+        caching.invalidate(cache_key)
 
     def has_perm(self, perm, obj=None):
         return self.is_admin
@@ -170,15 +343,24 @@ class User(models.Model):
     def remote(self):
         remote = dict()
         for backend in auth.get_backends():
-            if not hasattr(backend, "get_remote_user"):
+            if not hasattr(backend, "get_remote_profile"):
                 continue
             try:
-                remote.update(
-                    backend.get_remote_user(self.access_token))
+                profile, fetched = backend.get_remote_profile(
+                    self.access_token)
+                remote.update(profile)
+                self.remote_fetched = fetched
             except:
                 pass
         return remote
 
+    @property
+    def remote_age(self):
+        # Сколько секунд назад профиль был получен с Хабра.
+        if not self.remote or self.remote_fetched is None:
+            return None
+        return time.time() - self.remote_fetched
+
     @property
     def avatar(self):
         default = "https://habrahabr.ru/i/avatars/stub-user-middle.gif"
@@ -236,10 +418,23 @@ class User(models.Model):
         return not self.is_banned and invited and (good_guy or
             self.karma >= settings.CLUBADM_KARMA_LIMIT)
 
-    def send_notification(self, title, template_name, context=None):
-        text = render_to_string(template_name, context)
-        logger.debug("Отправляю уведомление: title=%s, text=%s", title, text)
-        send_notification.delay(self.access_token, title, text)
+    def send_message(self, kind, context=None):
+        """
+        Отправляет уведомление в трекер Хабра, а если у сообщения есть текст
+        письма, то и письмо.
+        """
+        context = dict(context or {}, user=self)
+        message = rendering.render_message(kind, context)
+        self.send_rendered_message(message)
+
+    def send_rendered_message(self, message):
+        logger.debug("Отправляю уведомление: title=%s, text=%s",
+                     message.title, message.text)
+        send_notification.delay(self.access_token, message.title, message.text)
+        if message.email:
+            # Почтовый сервис может тормозить, поэтому письмо уходит через
+            # очередь.
+            send_email.delay(self.id, message.title, message.email)
 
 
 class MemberManager(models.Manager):
@@ -250,6 +445,35 @@ class MemberManager(models.Manager):
         queryset = self.select_related("giftee").prefetch_related("santa")
         return queryset.get(user=user, season_id=year)
 
+    def _get_generation_key(self, year):
+        return "season:%d:members" % year
+
+    def get_cache_key(self, user_id, year):
+        # Поколение меняется, когда разом меняются все участники сезона,
+        # например после жеребьевки. Так не нужно удалять их по одному.
+        generation = caching.get_version(self._get_generation_key(year))
+        return "member:%d:%d:%d" % (year, user_id, generation)
+
+    def get_cached(self, user_id, year):
+        """
+        То же, что get_by_user_and_year(), вместе с получателем подарка и
+        Дедом Морозом, но из кеша. Если пользователь не участвует в сезоне,
+        возвращает None, и это тоже кешируется.
+        """
+        def load():
+            try:
+                return self.get_by_user_and_year(user_id, year)
+            except self.model.DoesNotExist:
+                return None
+        return caching.get_or_load(self.get_cache_key(user_id, year), load)
+
+    def invalidate(self, year, user_ids):
+        for user_id in user_ids:
+            caching.touch(self.get_cache_key(user_id, year))
+
+    def invalidate_season(self, year):
+        caching.touch(self._get_generation_key(year))
+
 
 class Member(models.Model):
     user = models.ForeignKey(User, verbose_name="пользователь")
@@ -276,6 +500,14 @@ class Member(models.Model):
     def __str__(self):
         return "%s (%s)" % (self.fullname, self.season)
 
+    def save(self, *args, **kwargs):
+        super(Member, self).save(*args, **kwargs)
+        Member.objects.invalidate(self.season_id, [self.user_id])
+
+    def delete(self, *args, **kwargs):
+        super(Member, self).delete(*args, **kwargs)
+        Member.objects.invalidate(self.season_id, [self.user_id])
+
     @property
     def is_gift_sent(self):
         return self.gift_sent is not None
@@ -285,44 +517,205 @@ class Member(models.Model):
         return self.gift_received is not None
 
     def read_mails(self, sender, timestamp):
+        send_date = timezone.make_aware(
+            datetime.datetime.fromtimestamp(timestamp))
+        read_date = timezone.now()
         Mail.objects.filter(
             sender=sender,
             recipient=self,
             read_date__isnull=True,
-            send_date__lte=timezone.make_aware(datetime.datetime.fromtimestamp(timestamp)),
-            send_date__gte=timezone.make_aware(datetime.datetime(2016, 12, 20))
-        ).update(read_date=timezone.now())
-        cache.delete(_get_mails_cache_key(self, sender))
+            send_date__lte=send_date,
+            send_date__gte=MAIL_UNREAD_SINCE
+        ).update(read_date=read_date)
+        Mail.objects.mark_read(sender, self, send_date, read_date)
 
     def send_mail(self, body, recipient):
         mail = Mail(body=body, sender=self, recipient=recipient)
         mail.save()
-
+        # Получатель узнает о новых сообщениях не сразу, а через
+        # CLUBADM_MAIL_DIGEST_DELAY секунд, одним уведомлением и письмом
+        # на все, что ему успели написать за это время.
+        digest_key = get_digest_cache_key(recipient.id, self.id)
+        delay = settings.CLUBADM_MAIL_DIGEST_DELAY
+        if cache.add(digest_key, True, timeout=delay * 2):
+            send_mail_digest.apply_async((recipient.id, self.id),
+                                         countdown=delay)
+        return mail
+
+    # Участник мог прийти из кеша, поэтому записываем только то, что
+    # поменяли, а не все поля разом.
     def send_gift(self):
         self.gift_sent = timezone.now()
-        self.save()
+        self.save(update_fields=["gift_sent"])
 
     def receive_gift(self):
         self.gift_received = timezone.now()
-        self.save()
+        self.save(update_fields=["gift_received"])
+
+    def unmatch(self):
+        """
+        Убирает участника из цикла после жеребьевки: его Дед Мороз теперь
+        дарит подарок его получателю. Остальных участников это не касается,
+        уведомления получают только эти двое. Возвращает False, если
+        участник и так ни с кем не связан.
+        """
+        with transaction.atomic():
+            # Без order_by() Django добавит JOIN на сезон ради сортировки,
+            # и FOR UPDATE заблокирует еще и его.
+            members = Member.objects.select_for_update().filter(
+                models.Q(pk=self.pk) | models.Q(giftee_id=self.pk)
+            ).order_by()
+            members = dict((member.pk, member) for member in members)
+            member = members.pop(self.pk)
+            if not member.giftee_id:
+                return False
+            if member.is_gift_sent:
+                # Иначе его получатель дождется двух подарков.
+                raise ValueError("Участник #%d уже отправил подарок"
+                                 % member.pk)
+            if not members:
+                raise ValueError("У участника #%d нет Деда Мороза" % member.pk)
+            santa = members.popitem()[1]
+            if santa.pk == member.giftee_id:
+                raise ValueError("Цикл из двух участников не разорвать")
+            if santa.is_gift_sent:
+                raise ValueError("Дед Мороз участника #%d уже отправил ему "
+                                 "подарок" % member.pk)
+            # Сначала отвязываем самого участника, иначе два Деда Мороза на
+            # мгновение окажутся у одного получателя.
+            Member.objects.filter(pk=member.pk).update(giftee=None)
+            Member.objects.filter(pk=santa.pk).update(
+                giftee_id=member.giftee_id)
+        self.giftee = None
+        logger.debug("Участник #%d исключен, #%d теперь дарит подарок #%d",
+                     member.pk, santa.pk, member.giftee_id)
+        users = list(User.objects.filter(models.Q(pk=santa.user_id) |
+                                         models.Q(member__pk=member.giftee_id)
+                                         ).order_by())
+        # Поменялись только сам участник, его Дед Мороз и его получатель.
+        Member.objects.invalidate(member.season_id, [member.user_id] +
+                                  [user.pk for user in users])
+        for user in users:
+            if user.pk == santa.user_id:
+                user.send_message("giftee_changed", {
+                    "year": member.season_id
+                })
+            else:
+                user.send_message("santa_changed")
+        return True
+
+
+def _get_mail_cache_key(mails_key, index):
+    return "%s:%d" % (mails_key, index)
+
+
+def _is_unread(mail):
+    return mail.read_date is None and mail.send_date >= MAIL_UNREAD_SINCE
 
 
 class MailManager(models.Manager):
+    """
+    Переписка хранится в кеше по одному сообщению на ключ, а под ключом
+    самой переписки лежит заголовок: версия, число сообщений, наибольший
+    id среди них и номера непрочитанных. Новое сообщение стоит пары
+    записей в кеш, а отметка о прочтении читает и переписывает только
+    непрочитанные сообщения, какой бы длинной ни была переписка. Если
+    версия в кеше не совпала с ожидаемой, переписка целиком перечитывается
+    из базы при следующем обращении.
+    """
+
+    def get_cache_key(self, member1, member2):
+        return _get_mails_cache_key(member1, member2)
+
     def get_between(self, member1, member2):
         mails_key = _get_mails_cache_key(member1, member2)
-        mails = cache.get(mails_key)
-        if not mails:
-            mails = list(self.filter(
-                models.Q(sender=member1, recipient=member2) |
-                models.Q(recipient=member1, sender=member2)
-            ))
-            cache.set(mails_key, mails, timeout=None)
+        version_key = caching.get_version_key(mails_key)
+        cached = cache.get_many([mails_key, version_key])
+        version = cached.get(version_key)
+        if version is None:
+            version = caching.get_version(mails_key)
+        header = cached.get(mails_key)
+        if header is not None and header[0] == version:
+            mail_keys = [_get_mail_cache_key(mails_key, i)
+                         for i in range(header[1])]
+            mails = cache.get_many(mail_keys)
+            if len(mails) == len(mail_keys):
+                return [mails[key] for key in mail_keys]
+        mails = list(self.filter(
+            models.Q(sender=member1, recipient=member2) |
+            models.Q(recipient=member1, sender=member2)
+        ))
+        values = dict((_get_mail_cache_key(mails_key, i), mail)
+                      for i, mail in enumerate(mails))
+        # Версия прочитана до запроса в базу. Если кто-то успел написать
+        # сообщение, пока мы читали, версия уже другая, и наша копия не
+        # будет принята за свежую.
+        values[mails_key] = (
+            version, len(mails), max([mail.id for mail in mails] or [0]),
+            tuple(i for i, mail in enumerate(mails) if _is_unread(mail)))
+        cache.set_many(values, timeout=None)
         return mails
 
+    def _get_header(self, mails_key):
+        # Сдвигает версию переписки и возвращает заголовок из кеша, если до
+        # этого кеш был свежим. Иначе возвращает None, и дописывать в кеш
+        # ничего не нужно: его все равно перечитают целиком.
+        version = caching.touch(mails_key)
+        header = cache.get(mails_key)
+        if header is None or header[0] != version - 1:
+            return None, version
+        return header, version
+
+    def append(self, mail):
+        mails_key = _get_mails_cache_key(mail.sender, mail.recipient)
+        header, version = self._get_header(mails_key)
+        if header is None:
+            return
+        _, count, last_id, unread = header
+        if mail.id <= last_id:
+            # Кеш перечитали из базы между INSERT и touch(), и сообщение в
+            # нем, скорее всего, уже есть. Оставляем заголовок со старой
+            # версией, чтобы следующий читатель собрал переписку заново.
+            return
+        # Без закешированных sender и recipient, как после запроса в базу.
+        mail = Mail(id=mail.id, body=mail.body, sender_id=mail.sender_id,
+                    recipient_id=mail.recipient_id, send_date=mail.send_date,
+                    read_date=mail.read_date)
+        if _is_unread(mail):
+            unread += (count,)
+        cache.set_many({
+            _get_mail_cache_key(mails_key, count): mail,
+            mails_key: (version, count + 1, mail.id, unread),
+        }, timeout=None)
+
+    def mark_read(self, sender, recipient, send_date, read_date):
+        mails_key = _get_mails_cache_key(sender, recipient)
+        header, version = self._get_header(mails_key)
+        if header is None:
+            return
+        _, count, last_id, unread = header
+        mail_keys = [_get_mail_cache_key(mails_key, i) for i in unread]
+        mails = cache.get_many(mail_keys)
+        if len(mails) != len(mail_keys):
+            return
+        values = dict()
+        still_unread = []
+        for index, key in zip(unread, mail_keys):
+            mail = mails[key]
+            if (mail.sender_id == sender.id and mail.read_date is None and
+                    mail.send_date <= send_date):
+                mail.read_date = read_date
+                values[key] = mail
+            else:
+                still_unread.append(index)
+        values[mails_key] = (version, count, last_id, tuple(still_unread))
+        cache.set_many(values, timeout=None)
+
 
 class Mail(models.Model):
     body = models.TextField(max_length=400)
-    sender = models.ForeignKey(Member, related_name="+")
+    # Поиск по отправителю покрывает индекс clubadm_mail_conversation.
+    sender = models.ForeignKey(Member, related_name="+", db_index=False)
     recipient = models.ForeignKey(Member, related_name="+")
     send_date = models.DateTimeField(default=timezone.now, db_index=True)
     read_date = models.DateTimeField(blank=True, null=True, db_index=True)
@@ -331,7 +724,16 @@ class Mail(models.Model):
 
     class Meta:
         ordering = ["send_date"]
+        indexes = [
+            # Переписка двух участников, см. MailManager.get_between().
+            models.Index(fields=["sender", "recipient", "send_date"],
+                         name="clubadm_mail_conversation"),
+        ]
 
     def save(self, *args, **kwargs):
+        adding = self._state.adding
         super(Mail, self).save(*args, **kwargs)
-        cache.delete(_get_mails_cache_key(self.sender, self.recipient))
+        if adding:
+            Mail.objects.append(self)
+        else:
+            caching.touch(_get_mails_cache_key(self.sender, self.recipient))
@@ -0,0 +1,66 @@
+import collections
+import os
+
+import jinja2
+
+from django.conf import settings
+
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), "jinja2")
+
+
+# Одно сообщение в трех видах: заголовок, текст уведомления в трекере Хабра
+# (там можно HTML) и текст письма. Если у сообщения нет письма, email равен
+# None.
+Message = collections.namedtuple("Message", "title text email")
+
+_environment = None
+
+
+def get_environment():
+    # Окружение создается один раз на процесс. Скомпилированные шаблоны
+    # оно держит у себя, а без auto_reload даже не проверяет, изменились
+    # ли файлы на диске.
+    global _environment
+    if _environment is None:
+        _environment = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(TEMPLATES_DIR),
+            autoescape=jinja2.select_autoescape(["html"]),
+            auto_reload=settings.DEBUG,
+            cache_size=-1,
+        )
+    return _environment
+
+
+def get_message_template(kind):
+    return get_environment().get_template("clubadm/messages/%s.html" % kind)
+
+
+def _render_block(template, name, context):
+    block = template.blocks.get(name)
+    if block is None:
+        return None
+    return jinja2.utils.concat(block(context)).strip()
+
+
+def _render_message(template, context):
+    context = template.new_context(context)
+    return Message(_render_block(template, "title", context),
+                   _render_block(template, "text", context),
+                   _render_block(template, "email", context))
+
+
+def render_message(kind, context=None):
+    """
+    Рендерит сообщение из clubadm/jinja2/clubadm/messages/<kind>.html.
+    """
+    return _render_message(get_message_template(kind), context or {})
+
+
+def render_messages(kind, contexts):
+    """
+    То же, что и render_message(), но сразу для многих получателей. Шаблон
+    достается из окружения один раз на всю пачку.
+    """
+    template = get_message_template(kind)
+    return [_render_message(template, context or {}) for context in contexts]
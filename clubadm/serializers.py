@@ -1,8 +1,13 @@
-from datetime import date
+import datetime
+import functools
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils import timezone
 
 from rest_framework import serializers
 
-from clubadm.models import Member, Season, Mail, User
+from clubadm.models import MAIL_UNREAD_SINCE, Member, Season, Mail, User
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -40,16 +45,16 @@ class SeasonSerializer(serializers.HyperlinkedModelSerializer):
                   "is_participatable", "gallery")
 
     def get_members(self, obj):
-        return obj.members
+        return obj.member_count
 
     def get_sent(self, obj):
-        return obj.sent
+        return obj.shipped_count
 
     def get_received(self, obj):
-        return obj.received
+        return obj.delivered_count
 
     def get_timeleft(self, obj):
-        timeleft = (obj.signups_end - date.today()).days
+        timeleft = (obj.signups_end - timezone.now().date()).days
         if timeleft > 0:
             return timeleft
         return None
@@ -66,6 +71,76 @@ class SeasonSerializer(serializers.HyperlinkedModelSerializer):
         return None
 
 
+def _get_mails(serializer, member1, member2):
+    # Переписка нужна и для списка сообщений, и для счетчика непрочитанных,
+    # так что в рамках одного ответа достаем ее из кеша только один раз.
+    if getattr(serializer, "_mails", None) is None:
+        serializer._mails = Mail.objects.get_between(member1, member2)
+    return serializer._mails
+
+
+def _count_unread(mails, sender):
+    return sum(1 for mail in mails if mail.sender_id == sender.id and
+               mail.read_date is None and mail.send_date >= MAIL_UNREAD_SINCE)
+
+
+def _get_timestamp(value):
+    return value.timestamp() if value else 0.0
+
+
+def get_conversation_delta(member, peer, since):
+    """
+    Возвращает изменения в переписке участника с peer после момента since:
+    новые сообщения и сообщения, которые с тех пор были прочитаны. Вторым
+    значением идет новый курсор, то есть самое позднее время отправки или
+    прочтения среди всех сообщений.
+
+    Изменения за последние CLUBADM_SYNC_OVERLAP секунд до since отдаются
+    повторно: они могли закоммититься уже после того, как клиент получил
+    свой курсор.
+    """
+    mails = Mail.objects.get_between(member, peer)
+    changed = []
+    cursor = since
+    overlap = datetime.timedelta(seconds=settings.CLUBADM_SYNC_OVERLAP)
+    for mail in mails:
+        changed_at = max(mail.send_date, mail.read_date or mail.send_date)
+        if changed_at > since - overlap:
+            changed.append(mail)
+            cursor = max(cursor, changed_at)
+    return {
+        "unread": _count_unread(mails, peer),
+        "mails": serialize_mails(changed, member.id),
+    }, cursor
+
+
+def get_member_delta(season, member, since):
+    """
+    То же, что SeasonSerializer и MemberSerializer, но без неизменных полей
+    и только с изменившимися сообщениями. Размер ответа не зависит от длины
+    переписки.
+    """
+    giftee, giftee_cursor = get_conversation_delta(
+        member, member.giftee, since)
+    giftee["is_gift_received"] = member.giftee.is_gift_received
+    santa, santa_cursor = get_conversation_delta(member, member.santa, since)
+    santa["is_gift_sent"] = member.santa.is_gift_sent
+    return {
+        "cursor": _get_timestamp(max(giftee_cursor, santa_cursor)),
+        "season": {
+            "members": season.member_count,
+            "sent": season.shipped_count,
+            "received": season.delivered_count,
+        },
+        "member": {
+            "is_gift_sent": member.is_gift_sent,
+            "is_gift_received": member.is_gift_received,
+            "giftee": giftee,
+            "santa": santa,
+        },
+    }
+
+
 class GifteeSerializer(serializers.ModelSerializer):
     unread = serializers.SerializerMethodField()
     mails = serializers.SerializerMethodField()
@@ -76,17 +151,10 @@ class GifteeSerializer(serializers.ModelSerializer):
                   "is_gift_received")
 
     def get_unread(self, obj):
-        import datetime
-        from django.utils import timezone
-        return Mail.objects.filter(
-            sender=obj,
-            recipient=obj.santa,
-            read_date__isnull=True,
-            send_date__gte=timezone.make_aware(datetime.datetime(2016, 12, 20))
-        ).count()
+        return _count_unread(_get_mails(self, obj, obj.santa), obj)
 
     def get_mails(self, obj):
-        mails = Mail.objects.get_between(obj, obj.santa)
+        mails = _get_mails(self, obj, obj.santa)
         return MailSerializer(mails, context={
             "author_id": obj.santa.id
         }, many=True).data
@@ -101,17 +169,10 @@ class SantaSerializer(serializers.ModelSerializer):
         fields = ("unread", "mails", "is_gift_sent")
 
     def get_unread(self, obj):
-        import datetime
-        from django.utils import timezone
-        return Mail.objects.filter(
-            sender=obj,
-            recipient=obj.giftee,
-            read_date__isnull=True,
-            send_date__gte=timezone.make_aware(datetime.datetime(2016, 12, 20))
-        ).count()
+        return _count_unread(_get_mails(self, obj, obj.giftee), obj)
 
     def get_mails(self, obj):
-        mails = Mail.objects.get_between(obj, obj.giftee)
+        mails = _get_mails(self, obj, obj.giftee)
         return MailSerializer(mails, context={
             "author_id": obj.giftee_id
         }, many=True).data
@@ -139,7 +200,124 @@ class MailSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Mail
-        fields = ("is_author", "body", "send_date", "read_date")
+        fields = ("id", "is_author", "body", "send_date", "read_date")
 
     def get_is_author(self, obj):
         return obj.sender_id == self.context["author_id"]
+
+
+# Быстрый путь для ответов: те же данные, что и у сериализаторов выше,
+# но без DRF, который на каждое поле заводит объект и проверки. Сериализаторы
+# остаются для разбора форм и как образец, с которым сверяются тесты.
+
+def _format_date(value):
+    return value.isoformat() if value else None
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_hour_offset(tz, hour):
+    # Перевод времени через pytz стоит дороже всего остального ответа,
+    # поэтому запоминаем смещение для каждого часа по UTC. Если внутри часа
+    # был переход на летнее время или обратно, не запоминаем ничего.
+    start = hour.astimezone(tz).utcoffset()
+    end = (hour + datetime.timedelta(hours=1)).astimezone(tz).utcoffset()
+    if start != end:
+        return None
+    return datetime.timezone(start)
+
+
+def _format_datetime(value, tz):
+    if not value:
+        return None
+    hour = value.replace(minute=0, second=0, microsecond=0)
+    offset = _get_hour_offset(tz, hour)
+    if offset is None:
+        value = value.astimezone(tz)
+    else:
+        value = value.astimezone(offset)
+    value = value.isoformat()
+    if value.endswith("+00:00"):
+        value = value[:-6] + "Z"
+    return value
+
+
+def serialize_user(user):
+    return {
+        "username": user.username,
+        "avatar": user.avatar,
+        "is_active": not user.is_banned,
+        "can_participate": user.can_participate,
+    }
+
+
+def serialize_season(season):
+    timeleft = (season.signups_end - timezone.now().date()).days
+    return {
+        "year": season.year,
+        "signups_start": _format_date(season.signups_start),
+        "signups_end": _format_date(season.signups_end),
+        "ship_by": _format_date(season.ship_by),
+        "members": season.member_count,
+        "sent": season.shipped_count,
+        "received": season.delivered_count,
+        "timeleft": timeleft if timeleft > 0 else None,
+        "is_closed": season.is_closed,
+        "is_participatable": season.is_participatable,
+        "gallery": season.gallery or None,
+    }
+
+
+def serialize_mail(mail, author_id, tz=None):
+    tz = tz or timezone.get_current_timezone()
+    return {
+        "id": mail.id,
+        "is_author": mail.sender_id == author_id,
+        "body": mail.body,
+        "send_date": _format_datetime(mail.send_date, tz),
+        "read_date": _format_datetime(mail.read_date, tz),
+    }
+
+
+def serialize_mails(mails, author_id):
+    tz = timezone.get_current_timezone()
+    return [serialize_mail(mail, author_id, tz) for mail in mails]
+
+
+def _get_related(member, name):
+    # Как и DRF, считаем отсутствующего Деда Мороза просто пустым полем.
+    try:
+        return getattr(member, name)
+    except ObjectDoesNotExist:
+        return None
+
+
+def serialize_member(member):
+    data = {
+        "fullname": member.fullname,
+        "postcode": member.postcode,
+        "address": member.address,
+        "giftee": None,
+        "santa": None,
+        "is_gift_sent": member.is_gift_sent,
+        "is_gift_received": member.is_gift_received,
+    }
+    giftee = _get_related(member, "giftee")
+    if giftee is not None:
+        mails = Mail.objects.get_between(giftee, member)
+        data["giftee"] = {
+            "fullname": giftee.fullname,
+            "postcode": giftee.postcode,
+            "address": giftee.address,
+            "unread": _count_unread(mails, giftee),
+            "mails": serialize_mails(mails, member.id),
+            "is_gift_received": giftee.is_gift_received,
+        }
+    santa = _get_related(member, "santa")
+    if santa is not None:
+        mails = Mail.objects.get_between(santa, member)
+        data["santa"] = {
+            "unread": _count_unread(mails, santa),
+            "mails": serialize_mails(mails, member.id),
+            "is_gift_sent": santa.is_gift_sent,
+        }
+    return data
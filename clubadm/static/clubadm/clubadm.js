@@ -14,8 +14,36 @@
 
     clubadm.controller("ProfileController", ["$scope", "$http", function($scope, $http) {
         var lastUpdate = 0;
+        var cursor = 0;
+        var polling = false;
+        var lastEventId = null;
         $scope.chat = {};
 
+        function getCursor(mails) {
+            var result = 0;
+            angular.forEach(mails, function(mail) {
+                result = Math.max(result, Date.parse(mail.send_date) / 1000);
+                if (mail.read_date) {
+                    result = Math.max(result, Date.parse(mail.read_date) / 1000);
+                }
+            });
+            // Date.parse() теряет микросекунды, так что последнее сообщение
+            // может прийти еще раз. Ничего страшного, мы сливаем их по id.
+            return Math.floor(result);
+        }
+
+        function mergeMails(mails, changed) {
+            angular.forEach(changed, function(mail) {
+                for (var i = 0; i < mails.length; i++) {
+                    if (mails[i].id == mail.id) {
+                        mails[i] = mail;
+                        return;
+                    }
+                }
+                mails.push(mail);
+            });
+        }
+
         function update(data) {
             lastUpdate = Math.floor(Date.now() / 1000);
             $scope.season = data.season;
@@ -30,6 +58,79 @@
             } else {
                 $scope.form = {};
             }
+
+            if (data.member && data.member.giftee) {
+                cursor = Math.max(getCursor(data.member.giftee.mails),
+                                  getCursor(data.member.santa.mails));
+                listen();
+            }
+        }
+
+        function sync() {
+            $http({
+                url: "/" + $scope.season.year + "/sync/",
+                method: "POST",
+                data: "since=" + cursor,
+                headers: {
+                    "Content-Type": "application/x-www-form-urlencoded"
+                }
+            }).then(function(response) {
+                var data = response.data;
+                var member = $scope.member;
+                angular.extend($scope.season, data.season);
+                member.is_gift_sent = data.member.is_gift_sent;
+                member.is_gift_received = data.member.is_gift_received;
+                angular.forEach(["giftee", "santa"], function(peer) {
+                    var delta = data.member[peer];
+                    mergeMails(member[peer].mails, delta.mails);
+                    delete delta.mails;
+                    angular.extend(member[peer], delta);
+                });
+                cursor = Math.max(cursor, data.cursor);
+            });
+        }
+
+        function pollEvents() {
+            var data = "";
+            if (lastEventId !== null) {
+                data = "last_id=" + lastEventId;
+            }
+            $http({
+                url: "/" + $scope.season.year + "/events/",
+                method: "POST",
+                data: data,
+                headers: {
+                    "Content-Type": "application/x-www-form-urlencoded"
+                }
+            }).then(function(response) {
+                var events = response.data.events;
+                // null значит, что часть событий потерялась. Что бы ни
+                // случилось, за подробностями идем в sync.
+                if (lastEventId !== null && (events === null || events.length)) {
+                    sync();
+                }
+                lastEventId = response.data.last_id;
+                schedulePoll();
+            }, schedulePoll);
+        }
+
+        function schedulePoll() {
+            setTimeout(function() {
+                // Пока вкладку не видно, сервер лишний раз не дергаем.
+                if (document.hidden) {
+                    schedulePoll();
+                } else {
+                    pollEvents();
+                }
+            }, window.eventsPollInterval * 1000);
+        }
+
+        function listen() {
+            if (polling) {
+                return;
+            }
+            polling = true;
+            pollEvents();
         }
 
         function readMails(year, sender, timestamp) {
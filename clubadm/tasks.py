@@ -1,34 +1,224 @@
 import logging
 import requests
+import time
+import tracemalloc
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, IntegerField, Value, When
+from django.utils import timezone
 
 from celery import shared_task
 
+from clubadm import caching, http, rendering
+from clubadm.matching import Matcher, Participant, count_cycles, get_region
+
 
 logger = logging.getLogger(__name__)
 
 
+MATCH_CHUNK_SIZE = 500
+
+MATCH_LOCK_TIMEOUT = 60 * 60
+
+NOTIFY_CHUNK_SIZE = 100
+
+
+def get_digest_cache_key(recipient_id, sender_id):
+    return "digest:%d:%d" % (recipient_id, sender_id)
+
+
+def get_match_history(year):
+    from clubadm.models import Member
+    return Member.objects.filter(
+        season_id__lt=year, giftee__isnull=False
+    ).order_by().values_list("user_id", "giftee__user_id")
+
+
+def get_participants(year):
+    from clubadm.models import Member
+    members = Member.objects.filter(season_id=year).order_by().values_list(
+        "id", "user_id", "postcode")
+    return [Participant(member_id, user_id, get_region(postcode))
+            for member_id, user_id, postcode in members]
+
+
+SIMULATION_TIMEOUT = 24 * 60 * 60
+
+
+def get_simulation_cache_key(year):
+    return "season:%d:simulation" % year
+
+
+def _simulate_matching(year):
+    started = time.perf_counter()
+    participants = get_participants(year)
+    history = list(get_match_history(year))
+    loaded = time.perf_counter()
+    matcher = Matcher(participants, forbidden=history,
+                      by_region=settings.CLUBADM_MATCH_BY_REGION)
+    pairs = matcher.match()
+    finished = time.perf_counter()
+    return matcher, pairs, history, loaded - started, finished - loaded
+
+
+def simulate_matching(year):
+    """
+    Проводит жеребьевку в памяти, ничего не записывая в базу, и возвращает
+    отчет: сколько заняла загрузка данных и сама жеребьевка, сколько памяти
+    понадобилось вместе с загруженными данными и какие получились циклы.
+    """
+    matcher, pairs, history, load_time, match_time = _simulate_matching(year)
+    # Под tracemalloc все работает в разы медленнее, поэтому память меряем
+    # отдельным прогоном, а время берем из первого.
+    tracemalloc.start()
+    try:
+        _simulate_matching(year)
+        memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    cycles = count_cycles(pairs)
+    report = matcher.count_violations()
+    report.update({
+        "members": len(pairs),
+        "history_pairs": len(history),
+        "load_time": load_time,
+        "match_time": match_time,
+        "memory": memory,
+        "cycles": len(cycles),
+        "shortest_cycle": min(cycles),
+    })
+    return report
+
+
+def format_matching_report(year, report):
+    return ("АДМ-{year}: участников {members}, пар в истории {history_pairs}; "
+            "загрузка {load_time:.2f} с, жеребьевка {match_time:.2f} с, "
+            "память {memory_mb:.1f} МБ; циклов {cycles} (самый короткий "
+            "{shortest_cycle}), повторов с прошлых лет {history}, "
+            "переездов между регионами {regions}").format(
+                year=year, memory_mb=report["memory"] / 1024.0 / 1024.0,
+                **report)
+
+
+@shared_task
+def run_matching_simulation(year):
+    """
+    То же, что simulate_matching(), но в воркере. Отчет кладется в кеш,
+    откуда его показывает админка.
+    """
+    try:
+        result = format_matching_report(year, simulate_matching(year))
+    except ValueError as e:
+        result = "АДМ-%d: %s" % (year, e)
+    cache.set(get_simulation_cache_key(year), result,
+              timeout=SIMULATION_TIMEOUT)
+
+
 @shared_task
-def match_members(year):
+def match_members(year, force=False):
+    """
+    Проводит жеребьевку, если она еще не проведена. Повторный запуск, в том
+    числе параллельный, ничего не делает, если только не передать force.
+    """
+    from clubadm.models import Member, Season
+    lock_key = "season:%d:matching" % year
+    if not cache.add(lock_key, True, timeout=MATCH_LOCK_TIMEOUT):
+        logger.info("Жеребьевка АДМ-%d уже идет", year)
+        return
+    try:
+        # Состояние RUNNING могло остаться от упавшего воркера. Раз мы
+        # держим блокировку, никто другой жеребьевку сейчас не проводит.
+        states = [Season.MATCHING_PENDING, Season.MATCHING_RUNNING]
+        if force:
+            states.append(Season.MATCHING_DONE)
+        seasons = Season.objects.filter(pk=year)
+        if not seasons.filter(matching__in=states).update(
+                matching=Season.MATCHING_RUNNING):
+            logger.info("Жеребьевка АДМ-%d уже проведена", year)
+            return
+        try:
+            _match_members(year)
+        except:
+            seasons.update(matching=Season.MATCHING_PENDING)
+            raise
+        finally:
+            caching.invalidate("season:%d" % year)
+            Member.objects.invalidate_season(year)
+    finally:
+        cache.delete(lock_key)
+
+
+def _match_members(year):
+    from clubadm.models import Member, Season
+    with transaction.atomic():
+        # Регистрация и отказ от участия сначала обновляют счетчик в строке
+        # сезона, так что, пока мы держим ее, состав участников не меняется,
+        # и никто не останется без получателя после members.update() ниже.
+        Season.objects.select_for_update().filter(pk=year).get()
+        participants = get_participants(year)
+        if len(participants) < 2:
+            logger.warning("В АДМ-%d некого сортировать", year)
+            Season.objects.filter(pk=year).update(
+                matching=Season.MATCHING_DONE)
+            return
+        matcher = Matcher(participants, forbidden=get_match_history(year),
+                          by_region=settings.CLUBADM_MATCH_BY_REGION)
+        pairs = matcher.match()
+        members = Member.objects.filter(season_id=year)
+        # Сначала отвязываем всех, иначе при повторной жеребьевке можно
+        # наткнуться на уникальность giftee посреди UPDATE.
+        members.update(giftee=None)
+        for i in range(0, len(pairs), MATCH_CHUNK_SIZE):
+            chunk = pairs[i:i + MATCH_CHUNK_SIZE]
+            members.filter(pk__in=[pk for pk, _ in chunk]).update(
+                giftee_id=Case(*[When(pk=pk, then=Value(giftee_id))
+                                 for pk, giftee_id in chunk],
+                               output_field=IntegerField()))
+        Season.objects.filter(pk=year).update(
+            matching=Season.MATCHING_DONE)
+        member_ids = [pk for pk, _ in pairs]
+        transaction.on_commit(lambda: _notify_matched_members(year, member_ids))
+    violations = matcher.count_violations()
+    logger.info("В АДМ-%d распределено участников: %d, повторов с прошлых "
+                "лет: %d, переездов между регионами: %d", year, len(pairs),
+                violations["history"], violations["regions"])
+
+
+@shared_task
+def match_due_seasons():
+    from clubadm.models import Season
+    today = timezone.now().date()
+    seasons = Season.objects.filter(
+        signups_end__lte=today, ship_by__gte=today,
+        matching=Season.MATCHING_PENDING)
+    for year in seasons.values_list("year", flat=True):
+        logger.info("Регистрация на АДМ-%d закончилась, запускаю жеребьевку",
+                    year)
+        match_members.delay(year)
+
+
+@shared_task
+def flush_season_counters():
+    from clubadm.models import Season
+    Season.objects.flush()
+
+
+def _notify_matched_members(year, member_ids):
+    for i in range(0, len(member_ids), NOTIFY_CHUNK_SIZE):
+        notify_matched_members.delay(year, member_ids[i:i + NOTIFY_CHUNK_SIZE])
+
+
+@shared_task
+def notify_matched_members(year, member_ids):
     from clubadm.models import Member
-    # TODO(kafeman): Придумать что-нибудь сложнее и интереснее.
-    members = Member.objects.filter(season_id=year).order_by("?")
-    last = len(members) - 1
-    for i, member in enumerate(members):
-        if i == last:
-            giftee = members[0]
-        else:
-            giftee = members[i + 1]
-        member.giftee = giftee
-        member.save()
-        logger.debug("%s отправляет подарок %s", member, giftee)
+    # Текст у всех одинаковый, так что рендерим его один раз на пачку.
+    message = rendering.render_message("match", {"year": year})
+    members = Member.objects.filter(pk__in=member_ids).select_related("user")
+    for member in members:
         try:
-            member.user.send_notification(
-                "Пора отправлять подарок!",
-                "clubadm/notifications/match.html", {
-                    "year": year
-                })
+            member.user.send_rendered_message(message)
         except:
             logger.warning("Не удалось отправить уведомление %s", member)
 
@@ -44,5 +234,56 @@ def send_notification(access_token, title, text):
         "title": title,
         "text": text
     }
-    response = requests.put(url, headers=headers, data=data)
+    response = http.put("habr.tracker", url, headers=headers, data=data)
     response.raise_for_status()
+
+
+@shared_task
+def refresh_remote_user(access_token):
+    from clubadm.auth_backends import TechMediaBackend
+    TechMediaBackend().refresh_remote_profile(access_token)
+
+
+def _post_email(user_id, subject, body):
+    url = "%s/users/%d/email" % (settings.CLUBADM_MAILER_URL, user_id)
+    response = http.post("mailer.email", url, json={
+        "subject": subject,
+        "body": body,
+    }, headers={
+        "X-Dumb-CSRF-Protection": "yes",
+    })
+    if response.status_code >= 500:
+        response.raise_for_status()
+    if response.status_code != 200:
+        # Например, пользователь отписался. Повторять тут нечего.
+        logger.warning("Письмо для %d не принято: %s", user_id, response.text)
+
+
+@shared_task(bind=True, max_retries=5, default_retry_delay=60)
+def send_email(self, user_id, subject, body):
+    try:
+        _post_email(user_id, subject, body)
+    except requests.RequestException as e:
+        raise self.retry(exc=e)
+
+
+@shared_task
+def send_mail_digest(recipient_id, sender_id):
+    from clubadm.models import Mail, Member
+    # Сообщения, пришедшие после этой строчки, запланируют новую рассылку.
+    # Лучше лишний раз напомнить о них, чем не напомнить вовсе.
+    cache.delete(get_digest_cache_key(recipient_id, sender_id))
+    count = Mail.objects.filter(sender_id=sender_id, recipient_id=recipient_id,
+                                read_date__isnull=True).count()
+    if not count:
+        # Получатель уже все прочитал, пока мы ждали.
+        return
+    recipient = Member.objects.select_related("user").get(pk=recipient_id)
+    if recipient.giftee_id == sender_id:
+        kind = "giftee_mail"
+    else:
+        kind = "santa_mail"
+    recipient.user.send_message(kind, {
+        "season": recipient.season,
+        "count": count,
+    })
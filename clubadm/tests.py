@@ -1,10 +1,34 @@
 import datetime
+import io
+import json
+import os
+import random
+import re
+import requests
+import threading
+import time
 
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, SESSION_KEY
 from django.core.cache import cache
-from django.test import TestCase, Client
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Q
+from django.middleware.csrf import _compare_salted_tokens
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, Client, RequestFactory, override_settings
 from django.utils import timezone
 
-from clubadm.models import Season, Member
+from celery.exceptions import Retry
+
+from clubadm import caching, events, http, rendering, serializers, views
+from clubadm.admin import MemberAdmin, SeasonAdmin, UserAdmin, site
+from clubadm.auth_backends import TechMediaBackend
+from clubadm.matching import Matcher, Participant, count_cycles, get_region
+from clubadm.tasks import flush_season_counters, get_simulation_cache_key, match_due_seasons, match_members, run_matching_simulation, simulate_matching, send_email, send_mail_digest
+from clubadm.models import COUNTERS_LOCK_KEY, MAIL_UNREAD_SINCE, Season, Member, Mail, User
+from clubadm.serializers import MailSerializer, MemberSerializer, SeasonSerializer, UserSerializer
 
 
 client = Client()
@@ -107,3 +131,1431 @@ class OldProfileViewTests(TestCase):
         cache.delete(season.cache_key)
         response = self.client.get("/profile")
         #self.assertRedirects(response, "/2013/profile/")
+
+
+class SeasonCounterTests(TestCase):
+    remote = {
+        "score": 100.0,
+        "is_rc": False,
+        "is_readonly": False,
+    }
+
+    def setUp(self):
+        today = timezone.now().date()
+        self.season = Season.objects.create(
+            year=2016,
+            signups_start=today - datetime.timedelta(days=1),
+            signups_end=today + datetime.timedelta(days=1),
+            ship_by=today + datetime.timedelta(days=2))
+        self.user = User.objects.create(pk=1, username="santa")
+        patcher = mock.patch(
+            "clubadm.auth_backends.TechMediaBackend.get_remote_profile",
+            return_value=(self.remote, time.time()))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(cache.clear)
+        self.addCleanup(caching.local_cache.clear)
+        # Client.force_login() отправляет user_logged_in без REMOTE_ADDR,
+        # и журнал действий падает, поэтому кладем пользователя в сессию сами.
+        session = self.client.session
+        session[SESSION_KEY] = str(self.user.pk)
+        session[BACKEND_SESSION_KEY] = "clubadm.auth_backends.TechMediaBackend"
+        session.save()
+
+    def create_member(self, user, **kwargs):
+        kwargs.setdefault("fullname", "Дед Мороз")
+        return Member.objects.create(
+            user=user, season=self.season, postcode="101000",
+            address="Москва", **kwargs)
+
+    def test_signup_and_signout(self):
+        response = self.client.post("/2016/signup/", {
+            "fullname": "Дед Мороз",
+            "postcode": "101000",
+            "address": "Москва",
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["season"]["members"], 1)
+        self.assertEqual(Season.objects.get(pk=2016).member_count, 1)
+
+        response = self.client.post("/2016/signout/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["season"]["members"], 0)
+        self.assertEqual(Season.objects.get(pk=2016).member_count, 0)
+
+    def test_signup_after_matching(self):
+        Season.objects.filter(pk=2016).update(
+            matching=Season.MATCHING_RUNNING)
+        response = self.client.post("/2016/signup/", {
+            "fullname": "Дед Мороз",
+            "postcode": "101000",
+            "address": "Москва",
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Member.objects.exists())
+        self.assertEqual(Season.objects.get(pk=2016).member_count, 0)
+
+    def test_signout_after_matching(self):
+        member = self.create_member(self.user)
+        other = self.create_member(User.objects.create(pk=2, username="other"))
+        Member.objects.get_cached(self.user.pk, 2016)
+        # Жеребьевка прошла, а в кеше остался участник без получателя.
+        Member.objects.filter(pk=member.pk).update(giftee=other)
+        Member.objects.filter(pk=other.pk).update(giftee=member)
+        response = self.client.post("/2016/signout/")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Member.objects.count(), 2)
+
+        Season.objects.filter(pk=2016).update(
+            matching=Season.MATCHING_DONE)
+        response = self.client.post("/2016/signout/")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Member.objects.count(), 2)
+
+    def test_no_count_queries(self):
+        cache.clear()
+        with self.assertNumQueries(1):
+            season = Season.objects.get_by_year(2016)
+        self.assertEqual(season.member_count, 0)
+        self.assertNotIn("COUNT", str(Season.objects.all().query))
+
+    def test_pending_counters(self):
+        Season.objects.recount()
+        Season.objects.increment(2016, "shipped_count")
+        Season.objects.increment(2016, "shipped_count")
+        Season.objects.increment(2016, "delivered_count")
+        self.assertEqual(Season.objects.get(pk=2016).shipped_count, 0)
+        season = Season.objects.get_by_year(2016)
+        self.assertEqual(season.shipped_count, 2)
+        self.assertEqual(season.delivered_count, 1)
+
+        with self.assertNumQueries(2):
+            flush_season_counters()
+        persisted = Season.objects.get(pk=2016)
+        self.assertEqual(persisted.shipped_count, 2)
+        self.assertEqual(persisted.delivered_count, 1)
+        self.assertEqual(Season.objects.get_pending(2016), {
+            "shipped_count": 0,
+            "delivered_count": 0,
+        })
+        season = Season.objects.get_by_year(2016)
+        self.assertEqual(season.shipped_count, 2)
+        self.assertEqual(season.delivered_count, 1)
+
+    def test_recount_subtracts_pending(self):
+        Season.objects.recount()
+        # Подарок уже в базе, и вьюха успела прибавить его в кеше.
+        self.create_member(self.user, gift_sent=timezone.now())
+        Season.objects.increment(2016, "shipped_count")
+        order_by = Member.objects.order_by
+
+        def count(*args, **kwargs):
+            # Этот подарок придет в кеш уже после того, как пересчет прочитал
+            # прибавки, и в подсчет не попадет.
+            Season.objects.increment(2016, "delivered_count")
+            return order_by(*args, **kwargs)
+
+        with mock.patch.object(Member.objects, "order_by", count):
+            Season.objects.recount()
+        self.assertEqual(Season.objects.get(pk=2016).shipped_count, 1)
+        self.assertEqual(Season.objects.get_pending(2016), {
+            "shipped_count": 0,
+            "delivered_count": 1,
+        })
+
+    def test_flush_is_exclusive(self):
+        Season.objects.recount()
+        Season.objects.increment(2016, "shipped_count")
+        cache.add(COUNTERS_LOCK_KEY, True)
+        with self.assertNumQueries(0):
+            flush_season_counters()
+        cache.delete(COUNTERS_LOCK_KEY)
+        # Если воркер упадет между записью в базу и вычитанием из кеша,
+        # прибавка останется в кеше, а не потеряется.
+        with mock.patch.object(cache, "decr", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                flush_season_counters()
+        self.assertEqual(Season.objects.get(pk=2016).shipped_count, 1)
+        self.assertEqual(Season.objects.get_pending(2016)["shipped_count"], 1)
+        self.assertIsNone(cache.get(COUNTERS_LOCK_KEY))
+
+    def test_lost_pending_counters(self):
+        self.create_member(self.user, gift_sent=timezone.now())
+        Season.objects.recount()
+        Season.objects.increment(2016, "shipped_count")
+        self.assertEqual(Season.objects.get_by_year(2016).shipped_count, 2)
+        # Memcached перезапустился: прибавки потеряны, и без ключа вьюхи
+        # пишут прямо в базу, пока счетчики не пересчитают.
+        cache.clear()
+        Season.objects.increment(2016, "delivered_count")
+        self.assertEqual(Season.objects.get(pk=2016).delivered_count, 1)
+        flush_season_counters()
+        season = Season.objects.get_by_year(2016)
+        self.assertEqual(season.shipped_count, 1)
+        self.assertEqual(season.delivered_count, 0)
+        Season.objects.increment(2016, "delivered_count")
+        self.assertEqual(Season.objects.get(pk=2016).delivered_count, 0)
+
+    def test_flush_after_eviction(self):
+        for pk, fullname in ((2, "Снегурочка"), (3, "Дед Мороз")):
+            self.create_member(
+                User.objects.create(pk=pk, username="user%d" % pk),
+                fullname=fullname, gift_sent=timezone.now(),
+                gift_received=timezone.now())
+        self.create_member(self.user, fullname="Кощей",
+                           gift_sent=timezone.now())
+        Season.objects.recount()
+        Season.objects.increment(2016, "shipped_count")
+        # Вытеснили только один счетчик, но пересчитываются все.
+        cache.delete("season:2016:pending:shipped_count")
+        flush_season_counters()
+        season = Season.objects.get(pk=2016)
+        self.assertEqual(season.member_count, 3)
+        self.assertEqual(season.shipped_count, 3)
+        self.assertEqual(season.delivered_count, 2)
+        self.assertEqual(Season.objects.get_pending(2016), {
+            "shipped_count": 0,
+            "delivered_count": 0,
+        })
+
+    def test_recount(self):
+        other = User.objects.create(pk=2, username="giftee")
+        self.create_member(self.user, gift_sent=timezone.now())
+        self.create_member(other, gift_sent=timezone.now(),
+                           gift_received=timezone.now())
+        Season.objects.get_by_year(2016)
+        Season.objects.recount()
+        season = Season.objects.get_by_year(2016)
+        self.assertEqual(season.member_count, 2)
+        self.assertEqual(season.shipped_count, 2)
+        self.assertEqual(season.delivered_count, 1)
+
+    def test_recount_distinct_names(self):
+        for pk, fullname in ((2, "Снегурочка"), (3, "Дед Мороз")):
+            self.create_member(
+                User.objects.create(pk=pk, username="user%d" % pk),
+                fullname=fullname, gift_sent=timezone.now())
+        self.create_member(self.user, fullname="Кощей")
+        Season.objects.recount()
+        season = Season.objects.get(pk=2016)
+        self.assertEqual(season.member_count, 3)
+        self.assertEqual(season.shipped_count, 2)
+        self.assertEqual(season.delivered_count, 0)
+
+
+@mock.patch("clubadm.models.send_mail_digest")
+class SyncViewTests(TestCase):
+    def setUp(self):
+        today = timezone.now().date()
+        self.season = Season.objects.create(
+            year=2016, signups_start=today, signups_end=today,
+            ship_by=today + datetime.timedelta(days=2))
+        self.members = []
+        for pk, username in ((1, "member"), (2, "giftee"), (3, "santa")):
+            self.members.append(Member.objects.create(
+                user=User.objects.create(pk=pk, username=username),
+                season=self.season, fullname="Дед Мороз", postcode="101000",
+                address="Москва"))
+        for santa, giftee in zip(self.members, self.members[1:] +
+                                 self.members[:1]):
+            santa.giftee = giftee
+            santa.save()
+        Season.objects.recount()
+        patcher = mock.patch(
+            "clubadm.auth_backends.TechMediaBackend.get_remote_profile",
+            return_value=(SeasonCounterTests.remote, time.time()))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(cache.clear)
+        self.addCleanup(caching.local_cache.clear)
+        self.login(1)
+
+    def login(self, user_id):
+        session = self.client.session
+        session[SESSION_KEY] = str(user_id)
+        session[BACKEND_SESSION_KEY] = "clubadm.auth_backends.TechMediaBackend"
+        session.save()
+
+    def sync(self, since):
+        response = self.client.post("/2016/sync/", {"since": since})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    @override_settings(CLUBADM_SYNC_OVERLAP=0)
+    def test_delta(self, send_mail_digest):
+        member, giftee, santa = self.members
+        member.send_mail("Привет", giftee)
+        santa.send_mail("Хо-хо-хо", member)
+        data = self.sync(0)
+        self.assertEqual(len(data["member"]["giftee"]["mails"]), 1)
+        self.assertTrue(data["member"]["giftee"]["mails"][0]["is_author"])
+        self.assertEqual(len(data["member"]["santa"]["mails"]), 1)
+        self.assertEqual(data["member"]["santa"]["unread"], 1)
+        self.assertEqual(data["season"]["members"], 3)
+
+        cursor = data["cursor"]
+        data = self.sync(cursor)
+        self.assertEqual(data["cursor"], cursor)
+        self.assertEqual(data["member"]["giftee"]["mails"], [])
+        self.assertEqual(data["member"]["santa"]["mails"], [])
+
+        member.read_mails(santa, time.time() + 1)
+        giftee.send_mail("Спасибо", member)
+        data = self.sync(cursor)
+        self.assertGreater(data["cursor"], cursor)
+        self.assertEqual(data["member"]["santa"]["unread"], 0)
+        self.assertEqual(
+            [mail["body"] for mail in data["member"]["santa"]["mails"]],
+            ["Хо-хо-хо"])
+        self.assertIsNotNone(data["member"]["santa"]["mails"][0]["read_date"])
+        self.assertEqual(
+            [mail["body"] for mail in data["member"]["giftee"]["mails"]],
+            ["Спасибо"])
+        self.assertEqual(data["member"]["giftee"]["unread"], 1)
+
+    def test_late_commit(self, send_mail_digest):
+        member, giftee, santa = self.members
+        member.send_mail("Привет", giftee)
+        cursor = self.sync(0)["cursor"]
+        # Сообщение получило время отправки раньше курсора, а закоммитилось
+        # позже.
+        late = member.send_mail("Еще раз привет", giftee)
+        late.send_date -= datetime.timedelta(seconds=10)
+        late.save()
+        cache.clear()
+        data = self.sync(cursor)
+        self.assertCountEqual(
+            [mail["body"] for mail in data["member"]["giftee"]["mails"]],
+            ["Привет", "Еще раз привет"])
+
+    def test_bad_cursor(self, send_mail_digest):
+        for since in ("вчера", "nan", "inf", "-inf", "1e300"):
+            response = self.client.post("/2016/sync/", {"since": since})
+            self.assertEqual(response.status_code, 400)
+
+    # Для хешированных имен статики нужен collectstatic.
+    @override_settings(STATICFILES_STORAGE="pipeline.storage.PipelineStorage")
+    def test_profile_etag(self, send_mail_digest):
+        member, giftee, santa = self.members
+        # Первый ответ выдает cookie с CSRF, а он входит в ETag.
+        self.client.get("/2016/profile/")
+        response = self.client.get("/2016/profile/")
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        self.assertIn("no-cache", response["Cache-Control"])
+        with mock.patch("clubadm.views.serialize_member") as serialize:
+            response = self.client.get("/2016/profile/",
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        serialize.assert_not_called()
+
+        santa.send_mail("Хо-хо-хо", member)
+        response = self.client.get("/2016/profile/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertIn("Хо-хо-хо", response.content.decode())
+
+    def test_profile_etag_skips_remote(self, send_mail_digest):
+        request = RequestFactory().get("/2016/profile/")
+        request.season = Season.objects.get_by_year(2016)
+        request.user = User.objects.get(pk=1)
+        request.member = Member.objects.get_cached(1, 2016)
+        with mock.patch("clubadm.auth_backends.TechMediaBackend."
+                        "get_remote_profile") as get_remote_profile:
+            views._get_profile_etag(request, 2016)
+        get_remote_profile.assert_not_called()
+
+    def test_compact_json(self, send_mail_digest):
+        response = self.client.post("/2016/sync/", {"since": 0})
+        self.assertNotIn(b"\n", response.content)
+        self.assertNotIn(b'": ', response.content)
+
+    @override_settings(STATICFILES_STORAGE="pipeline.storage.PipelineStorage")
+    def test_welcome_page_cache(self, send_mail_digest):
+        self.client.cookies.clear()
+        response = self.client.get("/2016/")
+        self.assertContains(response, "участников<br>3")
+        with mock.patch("clubadm.views.render_to_string") as render:
+            response = self.client.get("/2016/")
+        render.assert_not_called()
+        # Токены подставляются в готовую страницу на каждый запрос.
+        token = response.cookies["csrftoken"].value
+        content = response.content.decode()
+        state = re.search(r"state=(\w+)", content).group(1)
+        header = re.search(r'"X-CSRFToken": "(\w+)"', content).group(1)
+        self.assertTrue(_compare_salted_tokens(state, token))
+        self.assertTrue(_compare_salted_tokens(header, token))
+        self.assertIn("&amp;client_id=", content)
+        self.assertNotIn("marker", content)
+
+        Season.objects.filter(pk=2016).update(member_count=4)
+        caching.invalidate("season:2016")
+        self.assertContains(self.client.get("/2016/"), "участников<br>4")
+
+    def test_member_is_lazy(self, send_mail_digest):
+        with mock.patch.object(Member.objects, "get_by_user_and_year") as get:
+            response = self.client.get("/2016/")
+        self.assertRedirects(response, "/2016/profile/",
+                             fetch_redirect_response=False)
+        get.assert_not_called()
+
+    def test_member_is_cached(self, send_mail_digest):
+        self.sync(0)
+        with mock.patch.object(Member.objects, "get_by_user_and_year") as get:
+            self.sync(0)
+        get.assert_not_called()
+
+    @mock.patch("clubadm.models.send_email")
+    @mock.patch("clubadm.models.send_notification")
+    def test_gift_invalidates_member(self, send_notification, send_email,
+                                     send_mail_digest):
+        member, giftee, santa = self.members
+        self.login(2)
+        self.assertFalse(self.sync(0)["member"]["santa"]["is_gift_sent"])
+        self.login(1)
+        self.assertEqual(
+            self.client.post("/2016/send_gift/").status_code, 200)
+        self.assertTrue(self.sync(0)["member"]["is_gift_sent"])
+        self.login(2)
+        self.assertTrue(self.sync(0)["member"]["santa"]["is_gift_sent"])
+
+    def test_matching_invalidates_members(self, send_mail_digest):
+        self.sync(0)
+        Member.objects.filter(pk=self.members[0].pk).update(
+            address="Санкт-Петербург")
+        Member.objects.invalidate_season(2016)
+        with mock.patch.object(Member.objects, "get_by_user_and_year",
+                               wraps=Member.objects.get_by_user_and_year
+                               ) as get:
+            self.sync(0)
+        get.assert_called_once_with(1, 2016)
+
+    def poll_events(self, **data):
+        response = self.client.post("/2016/events/", data)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_poll_events(self, send_mail_digest):
+        member, giftee, santa = self.members
+        events.publish(member.id, "gift_sent")
+        # Старые события не приходят, их клиент получил вместе со страницей.
+        self.assertEqual(self.poll_events(), {"last_id": 1, "events": []})
+
+        self.login(3)
+        self.client.post("/2016/send_mail/", {
+            "recipient": "giftee",
+            "body": "Хо-хо-хо",
+        })
+        self.login(1)
+        data = self.poll_events(last_id=1)
+        self.assertEqual(data["last_id"], 2)
+        self.assertEqual(data["events"][0]["type"], "mail")
+        self.assertEqual(data["events"][0]["data"]["body"], "Хо-хо-хо")
+        self.assertFalse(data["events"][0]["data"]["is_author"])
+        self.assertEqual(self.poll_events(last_id=2)["events"], [])
+
+        cache.delete("events:%d:2" % member.id)
+        self.assertIsNone(self.poll_events(last_id=1)["events"])
+
+    @override_settings(CLUBADM_EVENTS_WAIT=1, CLUBADM_EVENTS_INTERVAL=0)
+    def test_poll_events_waits(self, send_mail_digest):
+        member = self.members[0]
+        with mock.patch("clubadm.views.time.sleep",
+                        side_effect=lambda _: events.publish(
+                            member.id, "read")) as sleep:
+            data = self.poll_events(last_id=0)
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(data["events"], [{"type": "read", "data": {}}])
+
+    def test_poll_events_requires_member(self, send_mail_digest):
+        self.client.cookies.clear()
+        response = self.client.post("/2016/events/")
+        self.assertEqual(response.status_code, 403)
+        self.login(1)
+        response = self.client.post("/2016/events/", {"last_id": "вчера"})
+        self.assertEqual(response.status_code, 400)
+
+
+class EventChannelTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_poll(self):
+        self.assertEqual(events.poll(1, 0), (0, []))
+        events.publish(1, "mail", {"body": "Привет"})
+        events.publish(1, "read")
+        events.publish(2, "gift_sent")
+        last_id, items = events.poll(1, 0)
+        self.assertEqual(last_id, 2)
+        self.assertEqual([item["type"] for item in items], ["mail", "read"])
+        self.assertEqual(events.poll(1, 1)[1][0]["type"], "read")
+        self.assertEqual(events.poll(1, 2), (2, []))
+
+    def test_lost_events(self):
+        events.publish(1, "mail")
+        events.publish(1, "read")
+        cache.delete("events:1:1")
+        self.assertEqual(events.poll(1, 0), (2, None))
+        self.assertEqual(events.poll(1, 1)[1][0]["type"], "read")
+        # Счетчик вытеснили, и он начался заново.
+        cache.delete("events:1")
+        events.publish(1, "gift_sent")
+        self.assertEqual(events.poll(1, 2), (1, None))
+
+
+class SingleFlightCacheTests(SimpleTestCase):
+    key = "test:singleflight"
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def run_concurrently(self, func, count=10):
+        results = []
+        def target():
+            results.append(func())
+        threads = [threading.Thread(target=target) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_misses_rebuild_once(self):
+        calls = []
+        def rebuild():
+            calls.append(1)
+            time.sleep(0.2)
+            return "fresh"
+        results = self.run_concurrently(
+            lambda: caching.get_or_rebuild(self.key, rebuild))
+        self.assertEqual(results, ["fresh"] * 10)
+        self.assertEqual(len(calls), 1)
+
+    def test_stale_value_served_during_rebuild(self):
+        caching.set_value(self.key, "stale")
+        cache.delete(self.key)
+        started = threading.Event()
+        release = threading.Event()
+        def rebuild():
+            started.set()
+            release.wait(5)
+            return "fresh"
+        thread = threading.Thread(
+            target=caching.get_or_rebuild, args=(self.key, rebuild))
+        thread.start()
+        started.wait(5)
+        results = self.run_concurrently(
+            lambda: caching.get_or_rebuild(self.key, rebuild))
+        self.assertEqual(results, ["stale"] * 10)
+        release.set()
+        thread.join()
+        self.assertEqual(cache.get(self.key), "fresh")
+
+    def test_wait_is_bounded(self):
+        cache.add(caching.get_lock_key(self.key), True)
+        with mock.patch("clubadm.caching.WAIT_TIMEOUT", 0.1):
+            started = time.monotonic()
+            value = caching.get_or_rebuild(self.key, lambda: "direct")
+        self.assertEqual(value, "direct")
+        self.assertLess(time.monotonic() - started, 1.0)
+
+
+class SeasonCacheTests(TestCase):
+    def setUp(self):
+        today = timezone.now().date()
+        self.season = Season.objects.create(
+            year=2016, signups_start=today, signups_end=today, ship_by=today)
+        self.addCleanup(cache.clear)
+        self.addCleanup(caching.local_cache.clear)
+
+    def test_stale_season_while_locked(self):
+        cache.delete(self.season.cache_key)
+        cache.add(caching.get_lock_key(self.season.cache_key), True)
+        with self.assertNumQueries(0):
+            season = Season.objects.get_by_year(2016)
+        self.assertEqual(season.year, 2016)
+
+    def test_rebuild_after_invalidation(self):
+        cache.delete(self.season.cache_key)
+        with self.assertNumQueries(1):
+            Season.objects.get_by_year(2016)
+        with self.assertNumQueries(0):
+            Season.objects.get_by_year(2016)
+
+    def test_local_copy_until_version_changes(self):
+        Season.objects.get_by_year(2016)
+        cache.delete_many([self.season.cache_key,
+                           caching.get_stale_key(self.season.cache_key)])
+        with self.assertNumQueries(0):
+            season = Season.objects.get_by_year(2016)
+        season.member_count += 1
+        self.assertEqual(Season.objects.get_by_year(2016).member_count, 0)
+
+        Season.objects.filter(pk=2016).update(member_count=5)
+        caching.invalidate(self.season.cache_key)
+        with self.assertNumQueries(1):
+            season = Season.objects.get_by_year(2016)
+        self.assertEqual(season.member_count, 5)
+
+    def test_rebuild_racing_invalidation(self):
+        def rebuild():
+            # Пока мы читали сезон, его поменяли и инвалидировали.
+            season = Season.objects.get(pk=2016)
+            Season.objects.filter(pk=2016).update(member_count=5)
+            caching.invalidate(self.season.cache_key)
+            return season
+
+        cache.delete(self.season.cache_key)
+        version = caching.get_version(self.season.cache_key)
+        season = caching.get_versioned(self.season.cache_key, rebuild,
+                                       version=version)
+        self.assertEqual(season.member_count, 0)
+        self.assertEqual(Season.objects.get_by_year(2016).member_count, 5)
+
+    def test_save_invalidates_local_copy(self):
+        Season.objects.get_by_year(2016)
+        self.season.gallery = "https://habr.com/post/1/"
+        self.season.save()
+        season = Season.objects.get_by_year(2016)
+        self.assertEqual(season.gallery, "https://habr.com/post/1/")
+
+
+class LocalCacheTests(SimpleTestCase):
+    def test_lru_eviction(self):
+        local_cache = caching.LocalCache(2)
+        local_cache.set("a", 1, "A")
+        local_cache.set("b", 1, "B")
+        local_cache.get("a", 1)
+        local_cache.set("c", 1, "C")
+        self.assertEqual(local_cache.get("a", 1), "A")
+        self.assertIsNone(local_cache.get("b", 1))
+        self.assertEqual(local_cache.get("c", 1), "C")
+
+    def test_version_mismatch(self):
+        local_cache = caching.LocalCache(2)
+        local_cache.set("a", 1, "A")
+        self.assertIsNone(local_cache.get("a", 2))
+        self.assertIsNone(local_cache.get("a", 1))
+
+
+class HomeViewTests(TestCase):
+    def setUp(self):
+        self.addCleanup(cache.clear)
+        self.addCleanup(caching.local_cache.clear)
+
+    def create_season(self, year):
+        today = timezone.now().date()
+        return Season.objects.create(
+            year=year, signups_start=today, signups_end=today, ship_by=today)
+
+    def test_latest_season_is_cached(self):
+        self.create_season(2015)
+        self.create_season(2016)
+        response = self.client.get("/")
+        self.assertRedirects(response, "/2016/", fetch_redirect_response=False)
+        with self.assertNumQueries(0):
+            response = self.client.get("/")
+        self.assertRedirects(response, "/2016/", fetch_redirect_response=False)
+
+    def test_new_season_invalidates_latest(self):
+        self.create_season(2016)
+        self.client.get("/")
+        self.create_season(2017)
+        response = self.client.get("/")
+        self.assertRedirects(response, "/2017/", fetch_redirect_response=False)
+
+        Season.objects.get(pk=2017).delete()
+        response = self.client.get("/")
+        self.assertRedirects(response, "/2016/", fetch_redirect_response=False)
+
+
+@mock.patch("clubadm.auth_backends.refresh_remote_user")
+@mock.patch("clubadm.auth_backends.http.get")
+class RemoteProfileCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.backend = TechMediaBackend()
+
+    def mock_response(self, requests_get, login, status_code=200):
+        requests_get.return_value = mock.Mock(status_code=status_code)
+        requests_get.return_value.json.return_value = {
+            "data": {"login": login}
+        }
+
+    def test_fresh_profile(self, requests_get, refresh_remote_user):
+        self.mock_response(requests_get, "santa")
+        self.backend.get_remote_user("token")
+        remote = self.backend.get_remote_user("token")
+        self.assertEqual(remote, {"login": "santa"})
+        self.assertEqual(requests_get.call_count, 1)
+        refresh_remote_user.delay.assert_not_called()
+
+    def test_stale_profile_refreshed_in_background(self, requests_get,
+                                                   refresh_remote_user):
+        self.mock_response(requests_get, "santa")
+        self.backend.get_remote_user("token")
+        later = time.time() + settings.CLUBADM_REMOTE_SOFT_TTL + 1
+        with mock.patch("clubadm.auth_backends.time.time", return_value=later):
+            remote, fetched = self.backend.get_remote_profile("token")
+            self.backend.get_remote_profile("token")
+        self.assertEqual(remote, {"login": "santa"})
+        self.assertEqual(requests_get.call_count, 1)
+        refresh_remote_user.delay.assert_called_once_with("token")
+
+        self.mock_response(requests_get, "grandpa")
+        self.backend.refresh_remote_profile("token")
+        remote, fetched = self.backend.get_remote_profile("token")
+        self.assertEqual(remote, {"login": "grandpa"})
+
+    def test_expired_profile_blocks(self, requests_get, refresh_remote_user):
+        self.mock_response(requests_get, "santa")
+        self.backend.get_remote_user("token")
+        cache.delete("token:token")
+        self.mock_response(requests_get, "grandpa")
+        self.assertEqual(self.backend.get_remote_user("token"),
+                         {"login": "grandpa"})
+        self.assertEqual(requests_get.call_count, 2)
+
+    def test_revoked_token(self, requests_get, refresh_remote_user):
+        self.mock_response(requests_get, "santa")
+        self.backend.get_remote_user("token")
+        self.mock_response(requests_get, "santa", status_code=401)
+        self.backend.refresh_remote_profile("token")
+        self.assertFalse(self.backend.get_remote_user("token"))
+
+    def test_remote_age(self, requests_get, refresh_remote_user):
+        self.mock_response(requests_get, "santa")
+        user = User(username="santa", access_token="token")
+        self.assertEqual(user.remote, {"login": "santa"})
+        self.assertLess(user.remote_age, 5)
+
+
+class UserCacheTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(pk=1, username="santa",
+                                        access_token="token")
+        self.addCleanup(cache.clear)
+
+    def test_read_through(self):
+        cache.clear()
+        with self.assertNumQueries(1):
+            User.objects.get_by_id(1)
+        with self.assertNumQueries(0):
+            user = User.objects.get_by_id(1)
+        self.assertEqual(user.username, "santa")
+
+    def test_save_updates_cache(self):
+        self.user.access_token = "new"
+        self.user.save()
+        with self.assertNumQueries(0):
+            user = User.objects.get_by_id(1)
+        self.assertEqual(user.access_token, "new")
+
+    def test_remote_is_not_cached(self):
+        self.user.remote_fetched = time.time()
+        self.user.__dict__["remote"] = {"login": "santa"}
+        self.user.save()
+        user = User.objects.get_by_id(1)
+        self.assertNotIn("remote", user.__dict__)
+        self.assertIsNone(user.remote_fetched)
+
+    def test_ban_action_invalidates(self):
+        User.objects.get_by_id(1)
+        UserAdmin(User, site).ban(None, User.objects.filter(pk=1))
+        self.assertTrue(User.objects.get_by_id(1).is_banned)
+
+    def test_concurrent_change_is_not_cached(self):
+        def load():
+            # Кто-то изменил пользователя, пока мы читали его из базы.
+            user = User.objects.get(pk=1)
+            User.objects.filter(pk=1).update(username="grandpa")
+            User.objects.invalidate([1])
+            return user
+        cache.clear()
+        self.assertEqual(
+            caching.get_or_load("user:1", load).username, "santa")
+        self.assertEqual(User.objects.get_by_id(1).username, "grandpa")
+
+    @mock.patch("clubadm.models.send_notification")
+    def test_ban_notification_sent_once(self, send_notification):
+        self.user.is_banned = True
+        self.user.save()
+        user = User.objects.get_by_id(1)
+        user.access_token = "new"
+        user.save()
+        self.assertEqual(send_notification.delay.call_count, 1)
+
+
+class HttpClientTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        patcher = mock.patch.object(http.get_session(), "request")
+        self.session_request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_shared_session(self):
+        self.assertIs(http.get_session(), http.get_session())
+        sessions = []
+        thread = threading.Thread(
+            target=lambda: sessions.append(http.get_session()))
+        thread.start()
+        thread.join()
+        self.assertEqual(sessions, [http.get_session()])
+
+    def test_session_per_process(self):
+        session = http.get_session()
+        with mock.patch("os.getpid", return_value=os.getpid() + 1):
+            self.assertIsNot(http.get_session(), session)
+        self.assertIsNot(http.get_session(), session)
+
+    def test_default_timeout(self):
+        self.session_request.return_value = mock.Mock(status_code=200)
+        http.get("habr.users_me", "http://localhost/users/me")
+        self.session_request.assert_called_once_with(
+            "GET", "http://localhost/users/me",
+            timeout=settings.CLUBADM_HTTP_TIMEOUT)
+
+    def test_stats(self):
+        self.session_request.return_value = mock.Mock(status_code=200)
+        http.post("mailer.email", "http://localhost/users/1/email")
+        self.session_request.return_value = mock.Mock(status_code=503)
+        http.post("mailer.email", "http://localhost/users/1/email")
+        self.session_request.side_effect = requests.Timeout()
+        with self.assertRaises(requests.Timeout):
+            http.post("mailer.email", "http://localhost/users/1/email")
+        stats = http.get_stats()
+        self.assertEqual(stats["mailer.email"]["count"], 3)
+        self.assertEqual(stats["mailer.email"]["errors"], 2)
+        self.assertIsNotNone(stats["mailer.email"]["latency"])
+        self.assertEqual(stats["habr.token"]["count"], 0)
+        self.assertIsNone(stats["habr.token"]["latency"])
+
+
+@mock.patch("clubadm.tasks.http.post")
+class SendEmailTaskTests(SimpleTestCase):
+    def test_send(self, post):
+        post.return_value = mock.Mock(status_code=200)
+        send_email(1, "Тема", "Текст")
+        self.assertEqual(post.call_count, 1)
+
+    @mock.patch("clubadm.tasks.send_email.retry")
+    def test_failed_email_is_retried(self, retry, post):
+        error = requests.ConnectionError()
+        post.side_effect = error
+        retry.side_effect = Retry()
+        with self.assertRaises(Retry):
+            send_email(1, "Тема", "Текст")
+        retry.assert_called_once_with(exc=error)
+
+
+@mock.patch("clubadm.models.send_email")
+@mock.patch("clubadm.models.send_notification")
+@mock.patch("clubadm.models.send_mail_digest")
+class MailDigestTests(TestCase):
+    def setUp(self):
+        today = timezone.now().date()
+        season = Season.objects.create(
+            year=2016, signups_start=today, signups_end=today, ship_by=today)
+        self.santa = Member.objects.create(
+            user=User.objects.create(pk=1, username="santa"), season=season,
+            fullname="Дед Мороз", postcode="101000", address="Москва")
+        self.giftee = Member.objects.create(
+            user=User.objects.create(pk=2, username="giftee"), season=season,
+            fullname="Снегурочка", postcode="101000", address="Москва")
+        self.santa.giftee = self.giftee
+        self.santa.save()
+        self.addCleanup(cache.clear)
+
+    def test_messages_collapse(self, send_mail_digest_mock, send_notification,
+                               send_email):
+        for i in range(10):
+            self.santa.send_mail("Привет %d" % i, self.giftee)
+        send_mail_digest_mock.apply_async.assert_called_once_with(
+            (self.giftee.id, self.santa.id),
+            countdown=settings.CLUBADM_MAIL_DIGEST_DELAY)
+
+        send_mail_digest(self.giftee.id, self.santa.id)
+        self.assertEqual(send_notification.delay.call_count, 1)
+        self.assertIn("непрочитанных сообщений: 10",
+                      send_notification.delay.call_args[0][2])
+        self.assertEqual(send_email.delay.call_count, 1)
+        self.assertEqual(send_email.delay.call_args[0][0], 2)
+        self.assertIn("Здравствуйте, giftee!",
+                      send_email.delay.call_args[0][2])
+
+        self.santa.send_mail("Еще одно", self.giftee)
+        self.assertEqual(send_mail_digest_mock.apply_async.call_count, 2)
+
+    def test_read_messages_are_skipped(self, send_mail_digest_mock,
+                                       send_notification, send_email):
+        self.giftee.send_mail("Спасибо!", self.santa)
+        Mail.objects.update(read_date=timezone.now())
+        send_mail_digest(self.santa.id, self.giftee.id)
+        send_notification.delay.assert_not_called()
+        send_email.delay.assert_not_called()
+
+
+@mock.patch("clubadm.models.send_mail_digest")
+class MemberPayloadTests(TestCase):
+    def setUp(self):
+        today = timezone.now().date()
+        season = Season.objects.create(
+            year=2016, signups_start=today, signups_end=today, ship_by=today)
+        self.members = []
+        for pk, username in ((1, "santa"), (2, "member"), (3, "giftee")):
+            self.members.append(Member.objects.create(
+                user=User.objects.create(pk=pk, username=username),
+                season=season, fullname="Дед Мороз", postcode="101000",
+                address="Москва"))
+        santa, member, giftee = self.members
+        santa.giftee = member
+        santa.save()
+        member.giftee = giftee
+        member.save()
+        self.addCleanup(cache.clear)
+
+    def get_payload(self):
+        member = Member.objects.get_by_user_and_year(2, 2016)
+        with self.assertNumQueries(0):
+            return MemberSerializer(member).data
+
+    def test_unread_from_cache(self, send_mail_digest):
+        santa, member, giftee = self.members
+        santa.send_mail("Привет", member)
+        santa.send_mail("Как дела?", member)
+        giftee.send_mail("Спасибо", member)
+        member.send_mail("Пожалуйста", giftee)
+        cache.clear()
+        # Первый ответ прогревает кеш переписки.
+        MemberSerializer(Member.objects.get_by_user_and_year(2, 2016)).data
+        data = self.get_payload()
+        self.assertEqual(data["santa"]["unread"], 2)
+        self.assertEqual(len(data["santa"]["mails"]), 2)
+        self.assertEqual(data["giftee"]["unread"], 1)
+        self.assertEqual(len(data["giftee"]["mails"]), 2)
+
+        member.read_mails(santa, time.time() + 1)
+        MemberSerializer(Member.objects.get_by_user_and_year(2, 2016)).data
+        self.assertEqual(self.get_payload()["santa"]["unread"], 0)
+
+    def test_empty_conversation_is_cached(self, send_mail_digest):
+        MemberSerializer(Member.objects.get_by_user_and_year(2, 2016)).data
+        data = self.get_payload()
+        self.assertEqual(data["santa"]["unread"], 0)
+        self.assertEqual(data["giftee"]["mails"], [])
+
+
+@mock.patch("clubadm.models.send_mail_digest")
+class ConversationCacheTests(TestCase):
+    def setUp(self):
+        today = timezone.now().date()
+        season = Season.objects.create(
+            year=2016, signups_start=today, signups_end=today, ship_by=today)
+        self.santa = Member.objects.create(
+            user=User.objects.create(pk=1, username="santa"), season=season,
+            fullname="Дед Мороз", postcode="101000", address="Москва")
+        self.giftee = Member.objects.create(
+            user=User.objects.create(pk=2, username="giftee"), season=season,
+            fullname="Снегурочка", postcode="101000", address="Москва")
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def get_bodies(self):
+        return [mail.body for mail in
+                Mail.objects.get_between(self.giftee, self.santa)]
+
+    def test_append(self, send_mail_digest):
+        self.assertEqual(self.get_bodies(), [])
+        for i in range(3):
+            self.santa.send_mail("Привет %d" % i, self.giftee)
+            with self.assertNumQueries(0):
+                self.assertEqual(len(self.get_bodies()), i + 1)
+        self.assertEqual(self.get_bodies(),
+                         ["Привет 0", "Привет 1", "Привет 2"])
+
+    def test_read_receipts(self, send_mail_digest):
+        self.santa.send_mail("Привет", self.giftee)
+        self.giftee.send_mail("Здравствуй", self.santa)
+        self.get_bodies()
+        self.giftee.read_mails(self.santa, time.time() + 1)
+        with self.assertNumQueries(0):
+            mails = Mail.objects.get_between(self.santa, self.giftee)
+        self.assertIsNotNone(mails[0].read_date)
+        self.assertIsNone(mails[1].read_date)
+        self.assertEqual(mails[0].read_date,
+                         Mail.objects.get(pk=mails[0].pk).read_date)
+
+    def test_stale_version_rebuilds(self, send_mail_digest):
+        self.santa.send_mail("Привет", self.giftee)
+        self.get_bodies()
+        # Кто-то изменил переписку в обход кеша, например через админку.
+        mail = Mail.objects.get()
+        mail.body = "Пока"
+        mail.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_bodies(), ["Пока"])
+
+    def test_evicted_mail_rebuilds(self, send_mail_digest):
+        self.santa.send_mail("Привет", self.giftee)
+        self.santa.send_mail("Как дела?", self.giftee)
+        self.get_bodies()
+        cache.delete("mails:%d:%d:1" % (self.santa.id, self.giftee.id))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_bodies(), ["Привет", "Как дела?"])
+        self.santa.send_mail("Ау", self.giftee)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_bodies(),
+                             ["Привет", "Как дела?", "Ау"])
+
+    def test_rebuild_before_append(self, send_mail_digest):
+        self.santa.send_mail("Привет", self.giftee)
+        self.get_bodies()
+        append = Mail.objects.append
+
+        def rebuild_and_append(mail):
+            # Кеш вытеснили, и читатель успел перечитать переписку из базы
+            # между INSERT и append().
+            cache.delete("mails:%d:%d:0" % (self.santa.id, self.giftee.id))
+            self.get_bodies()
+            append(mail)
+
+        with mock.patch.object(Mail.objects, "append", rebuild_and_append):
+            self.santa.send_mail("Как дела?", self.giftee)
+        self.assertEqual(self.get_bodies(), ["Привет", "Как дела?"])
+
+    def test_read_receipts_skip_read_mails(self, send_mail_digest):
+        for i in range(3):
+            self.santa.send_mail("Привет %d" % i, self.giftee)
+        self.giftee.read_mails(self.santa, time.time() + 1)
+        self.get_bodies()
+        self.santa.send_mail("Ау", self.giftee)
+        with mock.patch("clubadm.models.cache.get_many",
+                        wraps=cache.get_many) as get_many:
+            self.giftee.read_mails(self.santa, time.time() + 1)
+        self.assertEqual(len(get_many.call_args[0][0]), 1)
+        with self.assertNumQueries(0):
+            mails = Mail.objects.get_between(self.santa, self.giftee)
+        self.assertTrue(all(mail.read_date for mail in mails))
+
+
+@mock.patch("clubadm.models.send_mail_digest")
+class SerializerParityTests(TestCase):
+    def setUp(self):
+        today = timezone.now().date()
+        self.season = Season.objects.create(
+            year=2016, signups_start=today - datetime.timedelta(days=3),
+            signups_end=today + datetime.timedelta(days=1),
+            ship_by=today + datetime.timedelta(days=2), member_count=3)
+        self.members = []
+        for pk, username in ((1, "member"), (2, "giftee"), (3, "santa")):
+            self.members.append(Member.objects.create(
+                user=User.objects.create(pk=pk, username=username),
+                season=self.season, fullname="Дед Мороз %d" % pk,
+                postcode="10100%d" % pk, address="Москва"))
+        patcher = mock.patch(
+            "clubadm.auth_backends.TechMediaBackend.get_remote_profile",
+            return_value=(SeasonCounterTests.remote, time.time()))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(cache.clear)
+
+    def match(self):
+        for santa, giftee in zip(self.members, self.members[1:] +
+                                 self.members[:1]):
+            santa.giftee = giftee
+            santa.save()
+
+    def assertSameJSON(self, expected, actual):
+        self.assertEqual(json.dumps(expected, ensure_ascii=False),
+                         json.dumps(actual, ensure_ascii=False))
+
+    def test_season(self, send_mail_digest):
+        self.assertSameJSON(SeasonSerializer(self.season).data,
+                            serializers.serialize_season(self.season))
+        self.season.gallery = "https://habr.com/post/1/"
+        self.season.signups_end = timezone.now().date()
+        self.assertSameJSON(SeasonSerializer(self.season).data,
+                            serializers.serialize_season(self.season))
+
+    def test_user(self, send_mail_digest):
+        user = User.objects.get(pk=1)
+        self.assertSameJSON(UserSerializer(user).data,
+                            serializers.serialize_user(user))
+
+    def test_member_before_matching(self, send_mail_digest):
+        member = Member.objects.get_by_user_and_year(1, 2016)
+        self.assertSameJSON(MemberSerializer(member).data,
+                            serializers.serialize_member(member))
+
+    def test_mail_dates(self, send_mail_digest):
+        # В ночь на 26 октября 2014 года Москва перевела часы на час назад.
+        start = datetime.datetime(2014, 10, 25, 20, 0, 0, 123456,
+                                  tzinfo=timezone.utc)
+        for minutes in range(0, 6 * 60, 25):
+            mail = Mail(id=1, body="Привет", sender_id=1, recipient_id=2,
+                        send_date=start + datetime.timedelta(minutes=minutes))
+            self.assertSameJSON(
+                MailSerializer(mail, context={"author_id": 1}).data,
+                serializers.serialize_mail(mail, 1))
+
+    def test_member(self, send_mail_digest):
+        self.match()
+        member, giftee, santa = self.members
+        member.send_mail("Привет", giftee)
+        giftee.send_mail("<b>Здравствуй</b>", member)
+        santa.send_mail("Хо-хо-хо", member)
+        member.read_mails(santa, time.time() + 1)
+        member.send_gift()
+        member = Member.objects.get_by_user_and_year(1, 2016)
+        self.assertSameJSON(MemberSerializer(member).data,
+                            serializers.serialize_member(member))
+
+
+class MailIndexTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        today = timezone.now().date()
+        season = Season.objects.create(
+            year=2016, signups_start=today, signups_end=today, ship_by=today)
+        members = [Member.objects.create(
+            user=User.objects.create(pk=i, username="user%d" % i),
+            season=season, fullname="Дед Мороз", postcode="101000",
+            address="Москва") for i in range(1, 201)]
+        cls.santa, cls.giftee = members[:2]
+        # Как в настоящем сезоне: у каждого две переписки, в каждой пара
+        # десятков сообщений, и почти все прочитаны.
+        now = timezone.now()
+        mails = []
+        for santa, giftee in zip(members, members[1:] + members[:1]):
+            for i in range(20):
+                sender, recipient = (santa, giftee) if i % 2 else (giftee, santa)
+                mails.append(Mail(
+                    body="Сообщение", sender=sender, recipient=recipient,
+                    send_date=now - datetime.timedelta(hours=i),
+                    read_date=None if i < 2 else now))
+        Mail.objects.bulk_create(mails)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute("EXPLAIN " + sql, params)
+                return "\n".join(row[0] for row in cursor.fetchall())
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            return "\n".join(row[-1] for row in cursor.fetchall())
+
+    def assertNoSeqScan(self, queryset):
+        plan = self.explain(queryset)
+        self.assertNotRegex(
+            plan, r"(Seq Scan on|SCAN( TABLE)?) clubadm_mail\b", plan)
+
+    def test_conversation(self):
+        queryset = Mail.objects.filter(
+            Q(sender=self.santa, recipient=self.giftee) |
+            Q(recipient=self.santa, sender=self.giftee))
+        self.assertNoSeqScan(queryset)
+        self.assertIn("clubadm_mail_conversation", self.explain(queryset))
+
+    def test_unread(self):
+        now = timezone.now()
+        self.assertNoSeqScan(Mail.objects.filter(
+            sender=self.santa, recipient=self.giftee,
+            read_date__isnull=True, send_date__lte=now,
+            send_date__gte=MAIL_UNREAD_SINCE))
+        self.assertNoSeqScan(Mail.objects.filter(
+            sender=self.santa, recipient=self.giftee,
+            read_date__isnull=True).order_by())
+
+
+class RenderingTests(SimpleTestCase):
+    def test_message(self):
+        message = rendering.render_message("gift_received", {
+            "user": User(username="<santa>"),
+        })
+        self.assertEqual(message.title, "Ваш подарок получен")
+        self.assertEqual(message.text, "Ваш получатель отметил на сайте, "
+                                       "что подарок получен. Это круто!")
+        # Письмо уходит простым текстом, экранировать в нем нечего.
+        self.assertTrue(message.email.startswith(
+            "Привет, Дед Мороз <santa>!\n\n"))
+
+    def test_notification_only(self):
+        message = rendering.render_message("match", {"year": 2016})
+        self.assertIn('href="https://habra-adm.ru/2016/profile/"',
+                      message.text)
+        self.assertIsNone(message.email)
+
+    def test_text_is_escaped(self):
+        message = rendering.render_message("santa_mail", {
+            "season": Season(year=2016),
+            "count": "<b>",
+            "user": User(username="giftee"),
+        })
+        self.assertIn("&lt;b&gt;", message.text)
+
+    def test_batch(self):
+        messages = rendering.render_messages("santa_mail", [{
+            "season": Season(year=2016),
+            "count": count,
+            "user": User(username="giftee"),
+        } for count in (1, 2)])
+        self.assertIn("сообщений: 1.", messages[0].text)
+        self.assertIn("сообщений: 2.", messages[1].text)
+
+
+class MatchMembersTests(TransactionTestCase):
+    def setUp(self):
+        today = timezone.now().date()
+        self.season = Season.objects.create(
+            year=2016, signups_start=today, signups_end=today, ship_by=today)
+        for i in range(1, 13):
+            Member.objects.create(
+                user=User.objects.create(pk=i, username="user%d" % i),
+                season=self.season, fullname="Дед Мороз",
+                postcode="101000", address="Москва")
+        self.addCleanup(cache.clear)
+
+    def assertSingleCycle(self):
+        giftees = dict(Member.objects.filter(
+            season=self.season, giftee__isnull=False
+        ).values_list("id", "giftee_id"))
+        self.assertEqual(sorted(giftees.values()), sorted(giftees))
+        member_id = start = next(iter(giftees))
+        length = 0
+        while True:
+            member_id = giftees[member_id]
+            length += 1
+            if member_id == start:
+                break
+        self.assertEqual(length, len(giftees))
+
+    @mock.patch("clubadm.tasks.NOTIFY_CHUNK_SIZE", 5)
+    @mock.patch("clubadm.tasks.notify_matched_members")
+    def test_match(self, notify_matched_members):
+        with self.assertNumQueries(9):
+            match_members(2016)
+        self.assertSingleCycle()
+        self.assertEqual(notify_matched_members.delay.call_count, 3)
+        notified = []
+        for call in notify_matched_members.delay.call_args_list:
+            notified.extend(call[0][1])
+        self.assertEqual(sorted(notified),
+                         sorted(Member.objects.values_list("id", flat=True)))
+
+    @mock.patch("clubadm.tasks.notify_matched_members")
+    def test_rematch(self, notify_matched_members):
+        match_members(2016)
+        giftees = list(Member.objects.values_list("id", "giftee_id"))
+        self.assertEqual(Season.objects.get(pk=2016).matching,
+                         Season.MATCHING_DONE)
+        with self.assertNumQueries(2):
+            match_members(2016)
+        self.assertEqual(list(Member.objects.values_list("id", "giftee_id")),
+                         giftees)
+        match_members(2016, force=True)
+        self.assertSingleCycle()
+        self.assertEqual(notify_matched_members.delay.call_count, 2)
+
+    @mock.patch("clubadm.tasks.notify_matched_members")
+    def test_concurrent_match(self, notify_matched_members):
+        cache.add("season:2016:matching", True)
+        with self.assertNumQueries(0):
+            match_members(2016)
+        self.assertEqual(Season.objects.get(pk=2016).matching,
+                         Season.MATCHING_PENDING)
+
+    @mock.patch("clubadm.tasks.match_members")
+    def test_match_due_seasons(self, match_members_mock):
+        today = timezone.now().date()
+        Season.objects.filter(pk=2016).update(
+            signups_end=today, ship_by=today + datetime.timedelta(days=10))
+        match_due_seasons()
+        match_members_mock.delay.assert_called_once_with(2016)
+
+        Season.objects.filter(pk=2016).update(
+            signups_end=today + datetime.timedelta(days=1))
+        match_due_seasons()
+        self.assertEqual(match_members_mock.delay.call_count, 1)
+
+    @mock.patch("clubadm.tasks.notify_matched_members")
+    def test_no_notifications_on_failure(self, notify_matched_members):
+        with mock.patch("clubadm.tasks.transaction.on_commit",
+                        side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                match_members(2016)
+        self.assertFalse(Member.objects.filter(giftee__isnull=False).exists())
+        notify_matched_members.delay.assert_not_called()
+        self.assertEqual(Season.objects.get(pk=2016).matching,
+                         Season.MATCHING_PENDING)
+        self.assertIsNone(cache.get("season:2016:matching"))
+
+    @mock.patch("clubadm.tasks.notify_matched_members")
+    def test_history_is_avoided(self, notify_matched_members):
+        previous = Season.objects.create(
+            year=2015, signups_start=self.season.signups_start,
+            signups_end=self.season.signups_end, ship_by=self.season.ship_by)
+        members = [Member.objects.create(
+            user_id=i, season=previous, fullname="Дед Мороз",
+            postcode="101000", address="Москва") for i in range(1, 13)]
+        # В прошлом году каждый дарил подарок соседу по номеру.
+        for santa, giftee in zip(members, members[1:] + members[:1]):
+            santa.giftee = giftee
+            santa.save()
+        match_members(2016)
+        self.assertSingleCycle()
+        for member in Member.objects.filter(season=self.season):
+            self.assertNotIn(member.giftee.user_id - member.user_id, (1, -1, 11, -11))
+
+    @mock.patch("clubadm.models.send_notification")
+    @mock.patch("clubadm.tasks.notify_matched_members")
+    def test_unmatch(self, notify_matched_members, send_notification):
+        match_members(2016)
+        member = Member.objects.get(user_id=1)
+        santa, giftee = member.santa, member.giftee
+        bystander = Member.objects.exclude(
+            pk__in=[member.pk, santa.pk, giftee.pk]).first()
+        cache_keys = [Member.objects.get_cache_key(m.user_id, 2016)
+                      for m in (member, santa, giftee, bystander)]
+        versions = caching.get_versions(cache_keys)
+        with self.assertNumQueries(5):
+            member.unmatch()
+        changed = [old != new for old, new in
+                   zip(versions, caching.get_versions(cache_keys))]
+        self.assertEqual(changed, [True, True, True, False])
+        self.assertSingleCycle()
+        self.assertIsNone(Member.objects.get(pk=member.pk).giftee_id)
+        self.assertEqual(Member.objects.get(pk=santa.pk).giftee_id, giftee.pk)
+        self.assertEqual(send_notification.delay.call_count, 2)
+        self.assertEqual(
+            sorted(call[0][0] for call in send_notification.delay.call_args_list),
+            sorted([santa.user.access_token, giftee.user.access_token]))
+
+    @mock.patch("clubadm.tasks.notify_matched_members")
+    def test_unmatch_after_gift_sent(self, notify_matched_members):
+        match_members(2016)
+        member = Member.objects.get(user_id=1)
+        member.send_gift()
+        with self.assertRaises(ValueError):
+            member.unmatch()
+        self.assertIsNotNone(Member.objects.get(pk=member.pk).giftee_id)
+
+    @mock.patch("clubadm.models.send_notification")
+    @mock.patch("clubadm.tasks.notify_matched_members")
+    def test_unmatch_admin_reports_changes(self, notify_matched_members,
+                                           send_notification):
+        match_members(2016)
+        member = Member.objects.get(user_id=1)
+        Member.objects.filter(pk=member.pk).update(gift_sent=timezone.now())
+        # Получателя первого участника не берем: его Дед Мороз уже отправил
+        # подарок, и исключить его тоже не получится.
+        others = Member.objects.exclude(
+            pk__in=[member.pk, member.giftee_id]).order_by("pk")[:2]
+        queryset = Member.objects.filter(
+            pk__in=[member.pk] + [other.pk for other in others])
+        with mock.patch.object(MemberAdmin, "message_user") as message_user:
+            MemberAdmin(Member, site).unmatch(mock.Mock(), queryset)
+        messages = sorted(call[0][1] for call in message_user.call_args_list)
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0], "Исключено из жеребьевки участников: 2")
+        self.assertIn("уже отправил подарок", messages[1])
+
+        with mock.patch.object(MemberAdmin, "message_user") as message_user:
+            MemberAdmin(Member, site).unmatch(
+                mock.Mock(), Member.objects.filter(user_id=1))
+        self.assertEqual(message_user.call_count, 1)
+
+    @mock.patch("clubadm.models.send_notification")
+    def test_unmatch_two_members(self, send_notification):
+        first, second = Member.objects.all()[:2]
+        first.giftee = second
+        first.save()
+        second.giftee = first
+        second.save()
+        with self.assertRaises(ValueError):
+            first.unmatch()
+        self.assertEqual(Member.objects.get(pk=first.pk).giftee_id, second.pk)
+
+    def test_dry_run(self):
+        # Загрузка участников и истории: для замера времени и для замера
+        # памяти.
+        with self.assertNumQueries(4):
+            report = simulate_matching(2016)
+        self.assertEqual(report["members"], 12)
+        self.assertEqual(report["cycles"], 1)
+        self.assertEqual(report["shortest_cycle"], 12)
+        self.assertGreater(report["memory"], 0)
+        self.assertFalse(Member.objects.filter(giftee__isnull=False).exists())
+
+    def test_dry_run_task(self):
+        run_matching_simulation(2016)
+        report = cache.get(get_simulation_cache_key(2016))
+        self.assertIn("участников 12", report)
+        self.assertFalse(Member.objects.filter(giftee__isnull=False).exists())
+
+    @mock.patch("clubadm.admin.run_matching_simulation")
+    def test_dry_run_admin(self, run_matching_simulation_mock):
+        request = mock.Mock()
+        with mock.patch.object(SeasonAdmin, "message_user"):
+            SeasonAdmin(Season, site).simulate_matching(
+                request, Season.objects.all())
+        run_matching_simulation_mock.delay.assert_called_once_with(2016)
+
+    def test_dry_run_command(self):
+        out = io.StringIO()
+        call_command("match_members", "2016", "--dry-run", stdout=out)
+        self.assertIn("участников 12", out.getvalue())
+        self.assertIn("циклов 1", out.getvalue())
+        self.assertFalse(Member.objects.filter(giftee__isnull=False).exists())
+
+
+class MatcherTests(SimpleTestCase):
+    def assertSingleCycle(self, participants, pairs):
+        giftees = dict(pairs)
+        self.assertEqual(sorted(giftees), sorted(p.member_id for p in participants))
+        self.assertEqual(sorted(giftees.values()), sorted(giftees))
+        member_id, length = pairs[0][0], 0
+        while True:
+            member_id = giftees[member_id]
+            length += 1
+            if member_id == pairs[0][0]:
+                break
+        self.assertEqual(length, len(participants))
+
+    def test_count_cycles(self):
+        self.assertEqual(count_cycles([(1, 2), (2, 1), (3, 4), (4, 5),
+                                       (5, 3)]), [2, 3])
+
+    def test_get_region(self):
+        self.assertEqual(get_region("101000"), "101")
+        self.assertEqual(get_region(" sw1a 1aa"), "SW1")
+
+    def test_too_few_participants(self):
+        with self.assertRaises(ValueError):
+            Matcher([Participant(1, 1, "101")]).match()
+
+    def test_history(self):
+        participants = [Participant(i, i, "101") for i in range(100)]
+        history = [(i, (i + 1) % 100) for i in range(100)]
+        history += [(i, (i + 2) % 100) for i in range(100)]
+        matcher = Matcher(participants, history, rng=random.Random(1))
+        pairs = matcher.match()
+        self.assertSingleCycle(participants, pairs)
+        self.assertEqual(matcher.count_violations()["history"], 0)
+
+    def test_regions(self):
+        participants = [Participant(i, i, "%03d" % (i % 7)) for i in range(700)]
+        history = [(i, (i + 7) % 700) for i in range(700)]
+        matcher = Matcher(participants, history, by_region=True,
+                          rng=random.Random(1))
+        pairs = matcher.match()
+        self.assertSingleCycle(participants, pairs)
+        self.assertEqual(matcher.count_violations(), {
+            "history": 0,
+            "regions": 7,
+        })
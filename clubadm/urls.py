@@ -17,6 +17,8 @@ urlpatterns = [
     url(r"^(?P<year>[0-9]{4})/send_gift/$", views.send_gift, name="send_gift"),
     url(r"^(?P<year>[0-9]{4})/receive_gift/$", views.receive_gift, name="receive_gift"),
     url(r"^(?P<year>[0-9]{4})/read_mails/$", views.read_mails, name="read_mails"),
+    url(r"^(?P<year>[0-9]{4})/sync/$", views.sync, name="sync"),
+    url(r"^(?P<year>[0-9]{4})/events/$", views.poll_events, name="events"),
     url(r"^logout$", logout, {"next_page": "/"}),
     url(r"^profile$", views.profile_legacy),
     #url(r"^admin/", admin.site.urls),
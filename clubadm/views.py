@@ -1,21 +1,33 @@
+import datetime
+import functools
+import hashlib
 import json
+import os
 import logging
 import requests
 import html
+import time
 
 from django.conf import settings
 from django.contrib.auth import authenticate, login as auth_login
-from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import redirect, render
+from django.template.loader import render_to_string
 from django.utils import timezone
+from django.utils.html import escape
 from django.utils.http import urlencode
 from django.middleware.csrf import get_token
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from django.db import connection, transaction
 from django.db.models import F
 
+from clubadm import caching, encoding, events, http
 from clubadm.models import Season, Member, Mail
-from clubadm.serializers import SeasonSerializer, MemberSerializer, UserSerializer
+from clubadm.serializers import (
+    MemberSerializer, get_member_delta, serialize_mail, serialize_member,
+    serialize_season, serialize_user)
 from clubadm.signals import member_enrolled, member_unenrolled, giftee_mailed, santa_mailed, gift_sent, gift_received
 
 
@@ -28,7 +40,7 @@ class _AjaxException(Exception):
 
 class _AjaxResponse(HttpResponse):
     def __init__(self, data, status=200):
-        content = json.dumps(data, ensure_ascii=False, separators=(",", ": "), indent=2)
+        content = encoding.dumps(data)
         super(_AjaxResponse, self).__init__(
             content=content, status=status, charset="utf-8",
             content_type="application/json;charset=utf-8")
@@ -79,18 +91,9 @@ def _create_login_url(request, next):
     )
 
 
-def _send_email(user_id, subject, body):
-    requests.post("http://192.168.15.20:8080/users/{}/email".format(user_id), json={
-        "subject": subject,
-        "body": body,
-    }, headers={
-        "X-Dumb-CSRF-Protection": "yes",
-    })
-
-
 def home(request):
     try:
-        season = Season.objects.latest()
+        season = Season.objects.get_latest()
     except Season.DoesNotExist:
         return redirect("admin:clubadm_season_add")
     if request.user.is_authenticated:
@@ -98,32 +101,100 @@ def home(request):
     return redirect("welcome", year=season.year)
 
 
+# Вместо этих строк в закешированную страницу подставляются значения,
+# свои для каждого посетителя.
+_LOGIN_URL_MARKER = "clubadm-login-url-marker"
+
+_CSRF_TOKEN_MARKER = "clubadm-csrf-token-marker"
+
+WELCOME_TIMEOUT = 24 * 60 * 60
+
+
 def welcome(request, year):
     if request.user.is_authenticated:
         return redirect("profile", year=year)
+    # Анонимам страница отдается из кеша. Версия сезона меняется вместе со
+    # счетчиками, а от даты зависит, показывать ли плашку про архив.
+    page_key = "welcome:%d:%d:%s:%s" % (
+        request.season.year, caching.get_version(request.season.cache_key),
+        timezone.now().date().isoformat(), _get_release())
+    page = caching.get_or_rebuild(page_key, lambda: render_to_string(
+        "clubadm/welcome.html", {
+            "season": request.season,
+            "login_url": _LOGIN_URL_MARKER,
+            "csrf_token": _CSRF_TOKEN_MARKER,
+        }, request), timeout=WELCOME_TIMEOUT)
     login_url = _create_login_url(request, '/{}/profile/'.format(year))
-    return render(request, "clubadm/welcome.html", {
-        "season": request.season,
-        "login_url": login_url,
-    })
+    page = page.replace(_LOGIN_URL_MARKER, escape(login_url))
+    page = page.replace(_CSRF_TOKEN_MARKER, escape(get_token(request)))
+    return HttpResponse(page)
 
 
+def _get_profile_etag(request, year):
+    # Страница профиля целиком определяется версиями в кеше: сезона,
+    # пользователя, участника и обеих переписок. Если ни одна не поменялась,
+    # отвечаем 304, даже не доставая сами данные.
+    if request.user.is_anonymous:
+        return None
+    keys = [request.season.cache_key, request.user.cache_key]
+    member = request.member
+    if member:
+        keys.append(Member.objects.get_cache_key(request.user.pk,
+                                                 request.season.year))
+        if member.giftee_id:
+            keys.append(Mail.objects.get_cache_key(member, member.giftee))
+            keys.append(Mail.objects.get_cache_key(member, member.santa))
+    # Аватар и карма приходят с Хабра, remote_fetched говорит, насколько
+    # свежий у нас профиль. Его заполнил бэкенд авторизации, когда доставал
+    # пользователя, так что отсюда на Хабр никто не ходит.
+    state = caching.get_versions(keys) + [
+        request.user.pk,
+        request.user.remote_fetched,
+        # Эти счетчики меняются без новой версии сезона.
+        request.season.shipped_count,
+        request.season.delivered_count,
+        # От даты зависят timeleft и is_closed. Сериализаторы считают их по
+        # тем же часам.
+        timezone.now().date().isoformat(),
+        # Токен CSRF вшит в страницу.
+        request.META.get("CSRF_COOKIE"),
+        _get_release(),
+    ]
+    return hashlib.sha1(repr(state).encode()).hexdigest()
+
+
+@functools.lru_cache()
+def _get_release():
+    # После выкладки меняются шаблоны, скрипты и имена файлов статики, а с
+    # ними и страницы.
+    templates_dir = os.path.join(settings.BASE_DIR, "oldsanta/templates/clubadm")
+    paths = [os.path.join(templates_dir, name)
+             for name in os.listdir(templates_dir)]
+    paths.append(os.path.join(settings.BASE_DIR, "clubadm/static/clubadm/clubadm.js"))
+    paths.append(os.path.join(settings.STATIC_ROOT, "staticfiles.json"))
+    return max((os.path.getmtime(path) for path in paths
+                if os.path.exists(path)), default=0)
+
+
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=_get_profile_etag)
 def profile(request, year):
     if request.user.is_anonymous:
         return redirect("welcome", year=year)
 
     prefetched = {
-        "season": SeasonSerializer(request.season).data,
-        "user": UserSerializer(request.user).data,
+        "season": serialize_season(request.season),
+        "user": serialize_user(request.user),
         "member": None,
     }
 
     if request.member:
-        prefetched["member"] = MemberSerializer(request.member).data
+        prefetched["member"] = serialize_member(request.member)
 
     return render(request, "clubadm/profile.html", {
         "season": request.season,
-        "prefetched": html.escape(json.dumps(prefetched, ensure_ascii=False), quote=False),
+        "prefetched": html.escape(encoding.dumps(prefetched), quote=False),
+        "events_poll_interval": settings.CLUBADM_EVENTS_POLL_INTERVAL,
     })
 
 
@@ -147,15 +218,19 @@ def callback(request):
     if "error" in request.GET:
         return redirect("home")
 
-    response = requests.post(settings.TMAUTH_TOKEN_URL, data={
-        "grant_type": "authorization_code",
-        "code": request.GET.get("code"),
-        "client_id": settings.TMAUTH_CLIENT,
-        "client_secret": settings.TMAUTH_SECRET
-    })
+    try:
+        response = http.post("habr.token", settings.TMAUTH_TOKEN_URL, data={
+            "grant_type": "authorization_code",
+            "code": request.GET.get("code"),
+            "client_id": settings.TMAUTH_CLIENT,
+            "client_secret": settings.TMAUTH_SECRET
+        })
+    except requests.RequestException:
+        response = None
 
-    if response.status_code != 200:
-        logger.warning(response.text)
+    if response is None or response.status_code != 200:
+        if response is not None:
+            logger.warning(response.text)
         return HttpResponse("Хабр вернул ошибку. Попробуйте снова.",
                             content_type="text/plain;charset=utf-8")
 
@@ -167,14 +242,19 @@ def callback(request):
 
 def unsubscribe(request):
     user_id = int(request.GET.get("uid"))
-    response = requests.post("http://192.168.15.20:8080/users/{}/unsubscribe".format(user_id), json={
-        "token": request.GET.get("token"),
-    }, headers={
-        "X-Dumb-CSRF-Protection": "yes",
-        "X-Real-IP": request.META["REMOTE_ADDR"],
-    })
-    if response.status_code != 200:
-        logger.warning(response.text)
+    url = "{}/users/{}/unsubscribe".format(settings.CLUBADM_MAILER_URL, user_id)
+    try:
+        response = http.post("mailer.unsubscribe", url, json={
+            "token": request.GET.get("token"),
+        }, headers={
+            "X-Dumb-CSRF-Protection": "yes",
+            "X-Real-IP": request.META["REMOTE_ADDR"],
+        })
+    except requests.RequestException:
+        response = None
+    if response is None or response.status_code != 200:
+        if response is not None:
+            logger.warning(response.text)
         return HttpResponse("Мы честно пытались отписать вас, но произошла ошибка. Напишите, пожалуйста, <support@habra-adm.ru>.",
                             content_type="text/plain;charset=utf-8")
     return render(request, "clubadm/unsubscribed.html", {
@@ -193,13 +273,21 @@ def signup(request):
     serializer = MemberSerializer(data=request.POST)
     if not serializer.is_valid():
         raise _AjaxException("Форма заполнена неверно")
-    member = serializer.save(season=request.season, user=request.user)
-    cache.delete(request.season.cache_key)
-    request.season.members += 1
+    # Счетчик обновляется первым: блокировка строки сезона не дает
+    # зарегистрироваться посреди жеребьевки, а состояние жеребьевки
+    # проверяется уже после того, как мы дождались блокировки.
+    with transaction.atomic():
+        if not Season.objects.filter(
+                year=request.season.year, matching=Season.MATCHING_PENDING
+        ).update(member_count=F("member_count") + 1):
+            raise _AjaxException("Регистрация на этот сезон не возможна")
+        member = serializer.save(season=request.season, user=request.user)
+    caching.invalidate(request.season.cache_key)
+    request.season.member_count += 1
     member_enrolled.send(sender=Member, request=request, member=member)
     return _AjaxResponse({
-        "season": SeasonSerializer(request.season).data,
-        "member": serializer.data,
+        "season": serialize_season(request.season),
+        "member": serialize_member(member),
     })
 
 
@@ -207,12 +295,24 @@ def signup(request):
 def signout(request):
     if not request.season.is_participatable or request.member.giftee_id:
         raise _AjaxException("Время на решение истекло")
-    request.member.delete()
-    cache.delete(request.season.cache_key)
-    request.season.members -= 1
+    with transaction.atomic():
+        if not Season.objects.filter(
+                year=request.season.year, matching=Season.MATCHING_PENDING
+        ).update(member_count=F("member_count") - 1):
+            raise _AjaxException("Время на решение истекло")
+        # Участник мог прийти из кеша еще до жеребьевки. Удалять того, у
+        # кого уже есть получатель, нельзя: каскад по giftee унесет весь
+        # цикл вместе с перепиской.
+        deleted, _ = Member.objects.filter(
+            pk=request.member.pk, giftee__isnull=True).delete()
+        if not deleted:
+            raise _AjaxException("Время на решение истекло")
+    Member.objects.invalidate(request.season.year, [request.user.pk])
+    caching.invalidate(request.season.cache_key)
+    request.season.member_count -= 1
     member_unenrolled.send(sender=Member, request=request)
     return _AjaxResponse({
-        "season": SeasonSerializer(request.season).data,
+        "season": serialize_season(request.season),
         "member": None,
     })
 
@@ -226,34 +326,18 @@ def send_mail(request):
         raise _AjaxException("Вначале нужно что-то написать")
     recipient = request.POST.get("recipient", "")
     if recipient == "giftee":
-        request.member.send_mail(body, request.member.giftee)
-        request.member.giftee.user.send_notification(
-            "Новое сообщение от Деда Мороза",
-            "clubadm/notifications/santa_mail.html", {
-                "season": request.season
-            }
-        )
-        _send_email(request.member.giftee.user.id, "Новое сообщение от Деда Мороза",
-            "Здравствуйте, {}!\n\nВаш Дед Мороз написал вам что-то в анонимном чатике! ".format(request.member.giftee.user.username) +
-            "Посмотреть сообщение можно в профиле: https://habra-adm.ru/{}/profile/".format(request.season.year))
+        mail = request.member.send_mail(body, request.member.giftee)
+        _publish_mail(request.member.giftee, mail)
         giftee_mailed.send(sender=Member, request=request)
     elif recipient == "santa":
-        request.member.send_mail(body, request.member.santa)
-        request.member.santa.user.send_notification(
-            "Новое сообщение от получателя подарка",
-            "clubadm/notifications/giftee_mail.html", {
-                "season": request.season
-            }
-        )
-        _send_email(request.member.santa.user.id, "Новое сообщение от получателя подарка",
-            "Привет, Дед Мороз {}!\n\nВаш получатель написал вам что-то в анонимном чатике! ".format(request.member.santa.user.username) +
-            "Посмотреть сообщение можно в профиле: https://habra-adm.ru/{}/profile/".format(request.season.year))
+        mail = request.member.send_mail(body, request.member.santa)
+        _publish_mail(request.member.santa, mail)
         santa_mailed.send(sender=Member, request=request)
     else:
         raise _AjaxException("Неизвестный получатель")
     return _AjaxResponse({
-        "season": SeasonSerializer(request.season).data,
-        "member": MemberSerializer(request.member).data,
+        "season": serialize_season(request.season),
+        "member": serialize_member(request.member),
     })
 
 
@@ -266,14 +350,66 @@ def read_mails(request):
     except ValueError:
         raise _AjaxException("Нахрена тут строка?")
     if sender == "giftee":
-        request.member.read_mails(request.member.giftee, timestamp)
+        sender = request.member.giftee
     elif sender == "santa":
-        request.member.read_mails(request.member.santa, timestamp)
+        sender = request.member.santa
     else:
         raise _AjaxException("Неизвестный отправитель")
+    request.member.read_mails(sender, timestamp)
+    events.publish(sender.id, "read", {"timestamp": timestamp})
+    return _AjaxResponse({
+        "season": serialize_season(request.season),
+        "member": serialize_member(request.member),
+    })
+
+
+@_ajax_view(member_required=True, match_required=True)
+def sync(request):
+    try:
+        since = datetime.datetime.fromtimestamp(
+            float(request.POST.get("since", 0.0)), timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        # float() пропускает nan, inf и 1e300, а fromtimestamp() на них
+        # падает.
+        raise _AjaxException("Нахрена тут строка?")
+    return _AjaxResponse(get_member_delta(request.season, request.member, since))
+
+
+def _publish_mail(recipient, mail):
+    events.publish(recipient.id, "mail", serialize_mail(mail, recipient.id))
+
+
+@_ajax_view(member_required=True, match_required=False)
+def poll_events(request):
+    # Синхронный воркер на время ожидания ничем другим не занят, поэтому
+    # по умолчанию CLUBADM_EVENTS_WAIT нулевой и ответ уходит сразу. Держать
+    # запрос дольше стоит только на асинхронных воркерах.
+    member_id = request.member.id
+    if "last_id" not in request.POST:
+        # Первый запрос: все, что было раньше, клиент уже получил вместе со
+        # страницей.
+        return _AjaxResponse({
+            "last_id": events.get_last_id(member_id),
+            "events": [],
+        })
+    try:
+        last_id = int(request.POST["last_id"])
+    except ValueError:
+        raise _AjaxException("Нахрена тут строка?")
+    deadline = time.monotonic() + settings.CLUBADM_EVENTS_WAIT
+    while True:
+        new_last_id, items = events.poll(member_id, last_id)
+        if items != [] or time.monotonic() >= deadline:
+            break
+        # Соединение с базой держать незачем: дальше работаем только с кешем.
+        if not connection.in_atomic_block:
+            connection.close()
+        time.sleep(settings.CLUBADM_EVENTS_INTERVAL)
+    # Вместо списка событий None, если часть из них потерялась. Тогда
+    # клиенту нужно перечитать все через sync.
     return _AjaxResponse({
-        "season": SeasonSerializer(request.season).data,
-        "member": MemberSerializer(request.member).data,
+        "last_id": new_last_id,
+        "events": items,
     })
 
 
@@ -284,18 +420,16 @@ def send_gift(request):
     if request.member.is_gift_sent:
         raise _AjaxException("Вами уже был отправлен один подарок")
     request.member.send_gift()
-    cache.delete(request.season.cache_key)
-    request.season.sent += 1
-    request.member.giftee.user.send_notification(
-        "Вам отправлен подарок", "clubadm/notifications/gift_sent.html")
-    _send_email(request.member.giftee.user.id, "Вам отправлен подарок",
-        "Здравствуйте, {}!\n\nВаш Дед Мороз отметил на сайте, что подарок уже в пути. ".format(request.member.giftee.user.username) +
-        "Не забудьте и вы отметить на сайте, когда он придет!")
-    Season.objects.filter(year = request.season.year).update(shipped_count = F("shipped_count") + 1)
+    Season.objects.increment(request.season.year, "shipped_count")
+    request.season.shipped_count += 1
+    Member.objects.invalidate(request.season.year,
+                              [request.member.giftee.user_id])
+    request.member.giftee.user.send_message("gift_sent")
+    events.publish(request.member.giftee_id, "gift_sent")
     gift_sent.send(sender=Member, request=request)
     return _AjaxResponse({
-        "season": SeasonSerializer(request.season).data,
-        "member": MemberSerializer(request.member).data,
+        "season": serialize_season(request.season),
+        "member": serialize_member(request.member),
     })
 
 
@@ -306,18 +440,16 @@ def receive_gift(request):
     if request.member.is_gift_received:
         raise _AjaxException("Вами уже был получен один подарок")
     request.member.receive_gift()
-    cache.delete(request.season.cache_key)
-    request.season.received += 1
-    request.member.santa.user.send_notification(
-        "Ваш подарок получен", "clubadm/notifications/gift_received.html")
-    _send_email(request.member.santa.user.id, "Ваш подарок получен",
-        "Привет, Дед Мороз {}!\n\nВаш получатель отметил на сайте, что подарок получен. ".format(request.member.santa.user.username) +
-        "Это очень круто!")
-    Season.objects.filter(year = request.season.year).update(delivered_count = F("delivered_count") + 1)
+    Season.objects.increment(request.season.year, "delivered_count")
+    request.season.delivered_count += 1
+    Member.objects.invalidate(request.season.year,
+                              [request.member.santa.user_id])
+    request.member.santa.user.send_message("gift_received")
+    events.publish(request.member.santa.id, "gift_received")
     gift_received.send(sender=Member, request=request)
     return _AjaxResponse({
-        "season": SeasonSerializer(request.season).data,
-        "member": MemberSerializer(request.member).data,
+        "season": serialize_season(request.season),
+        "member": serialize_member(request.member),
     })
 
 
@@ -1,3 +1,4 @@
+import datetime
 import os
 
 
@@ -131,6 +132,24 @@ CELERY_ACCEPT_CONTENT = ["json"]
 
 CELERY_TASK_SERIALIZER = "json"
 
+# Письма и уведомления ждут ответа внешних сервисов. Пока один процесс
+# воркера ждет, задачи из очереди должны доставаться свободным, а не лежать
+# у него в запасе.
+CELERYD_PREFETCH_MULTIPLIER = 1
+
+CELERYBEAT_SCHEDULE = {
+    # Жеребьевка запускается сама, как только закончится регистрация.
+    "match-due-seasons": {
+        "task": "clubadm.tasks.match_due_seasons",
+        "schedule": datetime.timedelta(minutes=15),
+    },
+    # Счетчики подарков копятся в memcached и отсюда попадают в базу.
+    "flush-season-counters": {
+        "task": "clubadm.tasks.flush_season_counters",
+        "schedule": datetime.timedelta(minutes=1),
+    },
+}
+
 
 PIPELINE = {
     "STYLESHEETS": {
@@ -198,6 +217,41 @@ CLUBADM_ADMINS = (
 
 CLUBADM_KARMA_LIMIT = 10.0
 
+CLUBADM_LOCAL_CACHE_SIZE = 128
+
+CLUBADM_REMOTE_SOFT_TTL = 300
+
+CLUBADM_REMOTE_HARD_TTL = 3600
+
+CLUBADM_MAIL_DIGEST_DELAY = 180
+
+# Стараться отправлять подарки внутри одного региона (по индексу).
+CLUBADM_MATCH_BY_REGION = False
+
+CLUBADM_MAILER_URL = "http://192.168.15.20:8080"
+
+# Таймауты на установку соединения и чтение ответа, в секундах.
+CLUBADM_HTTP_TIMEOUT = (3.05, 10)
+
+CLUBADM_HTTP_POOL_SIZE = 10
+
+# Время отправки и прочтения проставляется до коммита, так что изменение
+# может стать видно позже, чем клиент получит курсор новее него. Поэтому sync
+# отдает изменения еще и за столько секунд до курсора, а клиент сливает
+# повторы по id.
+CLUBADM_SYNC_OVERLAP = 30
+
+# События для открытых профилей. Браузер спрашивает о них раз в
+# CLUBADM_EVENTS_POLL_INTERVAL секунд, а сервер может подождать новых событий
+# до CLUBADM_EVENTS_WAIT секунд, проверяя канал в кеше каждые
+# CLUBADM_EVENTS_INTERVAL секунд. Ожидание занимает воркер целиком, так что
+# на синхронных воркерах оно выключено.
+CLUBADM_EVENTS_POLL_INTERVAL = 15
+
+CLUBADM_EVENTS_WAIT = 0
+
+CLUBADM_EVENTS_INTERVAL = 1.0
+
 
 try:
     from oldsanta.local_settings import *